@@ -0,0 +1,116 @@
+from __future__ import print_function
+import argparse
+import io
+import os
+import random
+from xml.sax.saxutils import escape, quoteattr
+
+# Synthetic EAC-CPF corpus for the load benchmark.
+#
+# Writes RECORDS files shaped like the SNAC records the importers read, with
+# the given number of nameEntry, existDates, resourceRelation and cpfRelation
+# elements and a biogHist of about the given size each, and a list of their
+# filenames (files.txt) to give to the importers.  Resources are drawn from a
+# shared pool, as in the real corpus, and every cpfRelation points at another
+# record of the corpus, so the second pass has something to link.  The output
+# only depends on the options, so a corpus can be regenerated anywhere.
+
+ARK = "http://n2t.net/ark:/99166/w6b%07d"
+TERM = "http://socialarchive.iath.virginia.edu/control/term#"
+
+WORDS = ("archive correspondence papers letters records society collection family "
+         "county church school company university library diaries minutes reports "
+         "photographs journals accounts deeds maps sketches manuscripts notes").split()
+
+def sentence(rng, words):
+    return " ".join([rng.choice(WORDS) for n in range(words)]).capitalize() + "."
+
+def record(rng, k, args):
+    ark = ARK % k
+    out = []
+    out.append(u'<?xml version="1.0" encoding="UTF-8"?>\n')
+    out.append(u'<eac-cpf xmlns="urn:isbn:1-931666-33-4" xmlns:xlink="http://www.w3.org/1999/xlink" xmlns:snac="http://socialarchive.iath.virginia.edu/">\n')
+    out.append(u'  <control>\n')
+    out.append(u'    <recordId>%s</recordId>\n' % ark)
+    out.append(u'    <otherRecordId localType="%sMergedRecord">lc/n%07d</otherRecordId>\n' % (TERM, k))
+    out.append(u'    <maintenanceStatus>revised</maintenanceStatus>\n')
+    out.append(u'    <maintenanceAgency><agencyName>SNAC: Social Networks and Archival Context Project</agencyName></maintenanceAgency>\n')
+    out.append(u'    <languageDeclaration><language languageCode="eng">English</language><script scriptCode="Latn">Latin Alphabet</script></languageDeclaration>\n')
+    out.append(u'    <conventionDeclaration><citation>VIAF</citation></conventionDeclaration>\n')
+    out.append(u'    <maintenanceHistory>\n')
+    out.append(u'      <maintenanceEvent><eventType>revised</eventType><eventDateTime>2013-%02d-%02dT12:00:00</eventDateTime><agentType>machine</agentType><agent>XSLT tei2eac.xsl/MERGE</agent><eventDescription>Merged VIAF</eventDescription></maintenanceEvent>\n' % (rng.randint(1, 12), rng.randint(1, 28)))
+    out.append(u'      <maintenanceEvent><eventType>created</eventType><eventDateTime>2012-01-01T00:00:00</eventDateTime><agentType>machine</agentType><agent>XSLT tei2eac.xsl</agent></maintenanceEvent>\n')
+    out.append(u'    </maintenanceHistory>\n')
+    out.append(u'    <sources><source xlink:type="simple" xlink:href="http://www.worldcat.org/oclc/%d"/></sources>\n' % rng.randint(1, args.documents))
+    out.append(u'  </control>\n')
+    out.append(u'  <cpfDescription>\n')
+    out.append(u'    <identity>\n')
+    out.append(u'      <entityType>%s</entityType>\n' % rng.choice(("person", "person", "corporateBody", "family")))
+    for n in range(args.names):
+        name = u"%s, %s, %d-%d" % (rng.choice(WORDS).capitalize(), rng.choice(WORDS).capitalize(), 1800 + k % 100, 1860 + k % 100)
+        forms = u"<authorizedForm>LC</authorizedForm><alternativeForm>VIAF</alternativeForm>" if n == 0 else u"<alternativeForm>VIAF</alternativeForm>"
+        out.append(u'      <nameEntry snac:preferenceScore="%d"><part>%s</part>%s</nameEntry>\n' % (99 - n, escape(name), forms))
+    out.append(u'    </identity>\n')
+    out.append(u'    <description>\n')
+    for n in range(args.dates):
+        year = 1800 + rng.randint(0, 200)
+        if n == 0:
+            out.append(u'      <existDates><dateRange><fromDate standardDate="%d" localType="%sBirth">%d</fromDate><toDate standardDate="%d" localType="%sDeath">%d</toDate></dateRange></existDates>\n' % (year, TERM, year, year + 60, TERM, year + 60))
+        else:
+            out.append(u'      <existDates><date standardDate="%d" localType="%sActive">%d</date></existDates>\n' % (year, TERM, year))
+    out.append(u'      <localDescription localType="%sAssociatedSubject"><term>%s</term></localDescription>\n' % (TERM, rng.choice(WORDS).capitalize()))
+    out.append(u'      <localDescription localType="%snationalityOfEntity"><term>us</term></localDescription>\n' % TERM)
+    out.append(u'      <languageUsed><language languageCode="eng">English</language><script scriptCode="Latn">Latin Alphabet</script></languageUsed>\n')
+    out.append(u'      <occupation><term>%s</term></occupation>\n' % rng.choice(WORDS).capitalize())
+    if args.biog_size > 0:
+        paragraphs = []
+        size = 0
+        while size < args.biog_size:
+            p = sentence(rng, 12)
+            paragraphs.append(u"<p>%s</p>" % p)
+            size += len(p) + 7
+        out.append(u'      <biogHist>%s</biogHist>\n' % u"".join(paragraphs))
+    out.append(u'    </description>\n')
+    out.append(u'    <relations>\n')
+    for n in range(args.relations):
+        target = rng.randrange(args.records)
+        out.append(u'      <cpfRelation xlink:type="simple" xlink:arcrole="%s%s" xlink:href="%s" xlink:role="%sPerson"><relationEntry>%s</relationEntry></cpfRelation>\n' % (TERM, rng.choice(("associatedWith", "correspondedWith")), ARK % target, TERM, rng.choice(WORDS).capitalize()))
+    for n in range(args.resources):
+        doc = rng.randint(1, args.documents)
+        out.append(u'      <resourceRelation xlink:type="simple" xlink:arcrole="%s%s" xlink:href=%s xlink:role="%sArchivalResource"><relationEntry>%s</relationEntry><objectXMLWrap><container xmlns="http://example.com/">box %d</container></objectXMLWrap></resourceRelation>\n' % (TERM, rng.choice(("creatorOf", "referencedIn")), quoteattr("http://archives.example.org/doc/%d" % doc), TERM, escape(sentence(rng, 4)), doc))
+    out.append(u'    </relations>\n')
+    out.append(u'  </cpfDescription>\n')
+    out.append(u'</eac-cpf>\n')
+    return u"".join(out)
+
+# Write the corpus into directory, returning the name of its file list
+def generate(directory, args):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    rng = random.Random(args.seed)
+    listname = os.path.join(directory, "files.txt")
+    with io.open(listname, "w", encoding="utf-8") as files:
+        for k in range(args.records):
+            filename = os.path.join(directory, "r%07d.xml" % k)
+            with io.open(filename, "w", encoding="utf-8") as f:
+                f.write(record(rng, k, args))
+            files.write(filename + u"\n")
+    return listname
+
+# Register the corpus options, shared with the benchmark harness
+def add_arguments(parser):
+    parser.add_argument("--records", type=int, default=1000, metavar="N", help="records in the corpus (default: %(default)s)")
+    parser.add_argument("--names", type=int, default=3, metavar="N", help="nameEntry elements per record (default: %(default)s)")
+    parser.add_argument("--dates", type=int, default=2, metavar="N", help="existDates elements per record (default: %(default)s)")
+    parser.add_argument("--resources", type=int, default=5, metavar="N", help="resourceRelation elements per record (default: %(default)s)")
+    parser.add_argument("--relations", type=int, default=5, metavar="N", help="cpfRelation elements per record (default: %(default)s)")
+    parser.add_argument("--biog-size", type=int, default=2000, metavar="BYTES", help="approximate size of each record's biogHist (default: %(default)s)")
+    parser.add_argument("--documents", type=int, default=10000, metavar="N", help="size of the pool of resources and sources the records share (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=1, help="random seed (default: %(default)s)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic EAC-CPF corpus for the load benchmark")
+    parser.add_argument("directory", help="directory to write the corpus to")
+    add_arguments(parser)
+    args = parser.parse_args()
+    print(generate(args.directory, args))
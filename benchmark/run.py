@@ -0,0 +1,212 @@
+from __future__ import print_function
+import argparse
+import datetime
+import json
+import os
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import generate
+
+# End-to-end load benchmark.
+#
+# Generates a synthetic corpus (see generate.py), runs the first pass
+# (sql-first-import.py) and the second pass (rel-import.py) over it, and
+# reports the time and records/sec of each stage.  The importers run either
+# with their record backend (see dbbackend.py), which measures the importers'
+# own cost (plus a wait per round trip, with --latency), or with --postgres
+# against a throwaway Postgres cluster created with initdb for the run and
+# loaded with schema.sql.  Either way the run fails unless every record of the
+# corpus ends up in cpf (or, with the record backend, among its arks).
+#
+# Each result is appended, with the commit it was run at, to results.jsonl
+# (or --results FILE), and compared with the last earlier result for the
+# same corpus and options; --history lists them all.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT).decode().strip()
+        dirty = subprocess.call(["git", "diff", "--quiet", "HEAD"], cwd=ROOT) != 0
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("+" if dirty else "")
+
+def free_port():
+    s = socket.socket()
+    s.bind(("localhost", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+# Throwaway Postgres cluster in directory, with the snac role, the eaccpf
+# database and its schema, as the importers expect
+class Postgres(object):
+
+    def __init__(self, directory):
+        self.data = os.path.join(directory, "pgdata")
+        self.port = free_port()
+        self.log = open(os.path.join(directory, "postgres.log"), "w")
+
+    def start(self):
+        subprocess.check_call(["initdb", "-D", self.data, "-U", "postgres", "--auth=trust", "--encoding=UTF8"], stdout=self.log, stderr=self.log)
+        subprocess.check_call(["pg_ctl", "-D", self.data, "-w", "-l", os.path.join(self.data, "server.log"),
+                               "-o", "-p %d -c listen_addresses=localhost -c unix_socket_directories=''" % self.port, "start"],
+                              stdout=self.log, stderr=self.log)
+        psql = self.psql = ["psql", "-q", "-v", "ON_ERROR_STOP=1", "-h", "localhost", "-p", str(self.port)]
+        subprocess.check_call(psql + ["-U", "postgres", "-d", "postgres", "-c", "CREATE ROLE snac LOGIN SUPERUSER PASSWORD 'snacsnac'"], stdout=self.log, stderr=self.log)
+        subprocess.check_call(psql + ["-U", "postgres", "-d", "postgres", "-c", "CREATE DATABASE eaccpf OWNER snac"], stdout=self.log, stderr=self.log)
+        subprocess.check_call(psql + ["-U", "snac", "-d", "eaccpf", "-f", os.path.join(ROOT, "schema.sql")], stdout=self.log, stderr=self.log)
+
+    def arguments(self, stage):
+        return []
+
+    # Records the importers loaded, as read through the cpf view
+    def loaded(self):
+        return int(subprocess.check_output(self.psql + ["-U", "snac", "-d", "eaccpf", "-tA", "-c", "SELECT count(*) FROM cpf"]).decode().strip())
+
+    # The importers connect to localhost without a port, so libpq takes it from PGPORT
+    def environ(self):
+        env = dict(os.environ)
+        env["PGPORT"] = str(self.port)
+        return env
+
+    def stop(self):
+        subprocess.call(["pg_ctl", "-D", self.data, "-w", "-m", "fast", "stop"], stdout=self.log, stderr=self.log)
+
+# The importers' record backend, with its ark map kept between the stages
+class Recorded(object):
+
+    def __init__(self, directory, latency):
+        self.directory = directory
+        self.latency = latency
+
+    def start(self):
+        pass
+
+    def arguments(self, stage):
+        return ["--backend", "record",
+                "--record-state", os.path.join(self.directory, "record-state.json"),
+                "--record-counts", os.path.join(self.directory, "record-%s.json" % stage),
+                "--record-latency", str(self.latency)]
+
+    def environ(self):
+        return dict(os.environ)
+
+    def loaded(self):
+        with open(os.path.join(self.directory, "record-state.json")) as f:
+            return len(json.load(f)["arks"])
+
+    def counts(self, stage):
+        with open(os.path.join(self.directory, "record-%s.json" % stage)) as f:
+            return json.load(f)
+
+    def stop(self):
+        pass
+
+# Run one importer, with its chatter going to a log file, and time it
+def run_stage(name, command, env, directory):
+    with open(os.path.join(directory, name + ".log"), "w") as log:
+        start = time.time()
+        status = subprocess.call(command, cwd=ROOT, env=env, stdout=log, stderr=log)
+        seconds = time.time() - start
+    if status != 0:
+        raise SystemExit("%s failed with status %d, see %s" % (name, status, os.path.join(directory, name + ".log")))
+    return seconds
+
+def show(result):
+    print("%-10s %-12s %s" % (result["commit"], result["date"][:19], result["label"] or ""))
+    for stage in result["stages"]:
+        print("    %-18s %9.2f s %10.1f records/s" % (stage["stage"], stage["seconds"], stage["records_per_sec"]))
+
+def history(results):
+    if not os.path.exists(results):
+        return []
+    with open(results) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+parser = argparse.ArgumentParser(description="Time the importers end to end on a synthetic EAC-CPF corpus")
+generate.add_arguments(parser)
+parser.add_argument("--postgres", action="store_true", help="run against a throwaway Postgres cluster (needs initdb, pg_ctl and psql) instead of the record backend")
+parser.add_argument("--latency", type=float, default=0, metavar="MS", help="milliseconds the record backend waits on every round trip (default: %(default)s)")
+parser.add_argument("--python", default=sys.executable, help="interpreter to run the importers with (default: %(default)s)")
+parser.add_argument("--first-args", default="", metavar="ARGS", help="extra options for sql-first-import.py, e.g. \"--copy --client-ids\"")
+parser.add_argument("--rel-args", default="", metavar="ARGS", help="extra options for rel-import.py")
+parser.add_argument("--label", help="note to store with the result")
+parser.add_argument("--results", default=os.path.join(HERE, "results.jsonl"), metavar="FILE", help="file the results are appended to (default: %(default)s)")
+parser.add_argument("--keep", action="store_true", help="keep the work directory (corpus, logs, statement counts)")
+parser.add_argument("--history", action="store_true", help="list the stored results and exit")
+args = parser.parse_args()
+
+if args.history:
+    for result in history(args.results):
+        show(result)
+    sys.exit(0)
+
+work = tempfile.mkdtemp(prefix="snac-bench-")
+if args.postgres:
+    backend = Postgres(work)
+else:
+    backend = Recorded(work, args.latency)
+corpus = dict((k, getattr(args, k)) for k in ("records", "names", "dates", "resources", "relations", "biog_size", "documents", "seed"))
+stages = []
+try:
+    start = time.time()
+    files = generate.generate(os.path.join(work, "corpus"), args)
+    stages.append({"stage": "generate", "seconds": time.time() - start})
+    backend.start()
+    for name, script, extra in (("sql-first-import", "sql-first-import.py", args.first_args), ("rel-import", "rel-import.py", args.rel_args)):
+        command = [args.python, os.path.join(ROOT, script)] + backend.arguments(name) + shlex.split(extra) + [files]
+        stage = {"stage": name, "seconds": run_stage(name, command, backend.environ(), work)}
+        if not args.postgres:
+            stage["statements"] = backend.counts(name)
+        stages.append(stage)
+        if name == "sql-first-import" and backend.loaded() != args.records:
+            raise SystemExit("sql-first-import loaded %d of the %d records" % (backend.loaded(), args.records))
+finally:
+    backend.stop()
+    if args.keep:
+        print("Work directory:", work, file=sys.stderr)
+    else:
+        shutil.rmtree(work, ignore_errors=True)
+
+for stage in stages:
+    stage["records_per_sec"] = args.records / stage["seconds"] if stage["seconds"] > 0 else 0.0
+result = {
+    "commit": git_commit(),
+    "date": datetime.datetime.now().isoformat(),
+    "label": args.label,
+    "backend": "postgres" if args.postgres else "record",
+    "latency_ms": args.latency,
+    "python": args.python,
+    "first_args": args.first_args,
+    "rel_args": args.rel_args,
+    "corpus": corpus,
+    "stages": stages,
+}
+show(result)
+for stage in stages:
+    if "statements" in stage:
+        print("    %-18s %d round trips" % (stage["stage"], stage["statements"].get("round trips", 0)))
+
+# Compare with the last run of the same benchmark
+same = ("backend", "latency_ms", "first_args", "rel_args", "corpus")
+earlier = [r for r in history(args.results) if all([r.get(k) == result[k] for k in same])]
+if earlier:
+    last = earlier[-1]
+    print("Compared with", last["commit"], "of", last["date"][:19] + ":")
+    before = dict((s["stage"], s) for s in last["stages"])
+    for stage in stages:
+        if stage["stage"] in before and before[stage["stage"]]["records_per_sec"] > 0:
+            change = stage["records_per_sec"] / before[stage["stage"]]["records_per_sec"] - 1
+            print("    %-18s %+7.1f%%" % (stage["stage"], change * 100))
+
+with open(args.results, "a") as f:
+    f.write(json.dumps(result, sort_keys=True) + "\n")
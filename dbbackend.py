@@ -0,0 +1,285 @@
+from __future__ import print_function
+import atexit
+import collections
+import io
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+# Database backends for the importers.
+#
+# The importers get their connections from connect(args), which hands out one
+# of the following, as chosen with --backend:
+#
+#   postgres  a psycopg2 connection to --dsn (the default)
+#   record    a stand-in that answers every statement at once, without a
+#             server, and counts them by kind and table
+#   sql       the record stand-in, also writing every statement (with its
+#             parameters filled in) and COPY to --sql-file
+#
+# The stand-in hands out made-up ids where the importers need ids back, and
+# remembers just enough to answer them consistently: the ids of the rows with
+# a unique key, and the ark_id of every cpf row.  With --record-state FILE
+# that is kept between runs, so rel-import.py can link the records a run of
+# sql-first-import.py "inserted".  --record-latency adds a wait to every round
+# trip, to stand in for a server.  This way the parse path can be measured on
+# its own, and the statements the importers send can be counted and read.
+# The ids in a --sql-file are the made-up ones, so the file shows what would
+# be sent; it is not meant to be replayed into a database.
+
+BACKENDS = ("postgres", "record", "sql")
+
+DEFAULT_DSN = "host=localhost dbname=eaccpf user=snac password=snacsnac"
+
+# Register the backend options, shared by the importers
+def add_arguments(parser):
+    parser.add_argument("--backend", choices=BACKENDS, default="postgres", help="where the statements go: a Postgres server, a recording stand-in that counts them, or the stand-in writing them to --sql-file (default: %(default)s)")
+    parser.add_argument("--dsn", default=DEFAULT_DSN, help="psycopg2 connection string of the postgres backend (default: %(default)r)")
+    parser.add_argument("--sql-file", metavar="FILE", help="file the sql backend writes the statements to")
+    parser.add_argument("--record-counts", metavar="FILE", help="write the statement counts of the record and sql backends to FILE as JSON at exit")
+    parser.add_argument("--record-state", metavar="FILE", help="keep the record and sql backends' cpf arks and ids in FILE between runs")
+    parser.add_argument("--record-latency", type=float, default=0, metavar="MS", help="milliseconds the record and sql backends wait on every round trip (default: %(default)s)")
+
+# Python 2/3 text type
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+def text(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return value
+
+# Format a value as an SQL literal
+def sql_literal(value):
+    if value is None:
+        return u"NULL"
+    if value is True:
+        return u"true"
+    if value is False:
+        return u"false"
+    if isinstance(value, (int, float)) or type(value).__name__ == "long":
+        return text_type(value)
+    if isinstance(value, (list, tuple)):
+        return u"ARRAY[" + u",".join([sql_literal(v) for v in value]) + u"]"
+    value = text(value)
+    if not isinstance(value, text_type):
+        value = text_type(value)
+    return u"'" + value.replace(u"'", u"''") + u"'"
+
+# psycopg2 sends Python 3 bytes as bytea, never as text, so the stand-in
+# refuses bytes parameters rather than take them for text
+def check_parameters(args):
+    if bytes is str or args is None:
+        return
+    if isinstance(args, dict):
+        args = args.values()
+    for value in args:
+        if isinstance(value, (list, tuple)):
+            check_parameters(value)
+        elif isinstance(value, bytes):
+            raise TypeError("bytes parameter %r would reach Postgres as bytea" % value[:40])
+
+# Fill in the parameters of a statement, as psycopg2 would
+def mogrify(sql, args):
+    sql = text(sql)
+    if args is None:
+        return sql
+    if isinstance(args, dict):
+        return sql % dict((k, sql_literal(v)) for k, v in args.items())
+    return sql % tuple([sql_literal(v) for v in args])
+
+TABLE = re.compile(r"(?:INSERT INTO|UPDATE|FROM|COPY)\s+(\w+)", re.I)
+COLUMNS = re.compile(r"INSERT INTO \w+ \(([^)]*)\)")
+CONFLICT = re.compile(r"ON CONFLICT \(([^)]*)\)")
+WHERE_ID = re.compile(r"WHERE id=(\d+)")
+
+# The state of the stand-in, shared by all its connections in a process
+class Recorder(object):
+
+    def __init__(self, state=None, counts=None, latency=0, out=None):
+        self.lock = threading.RLock()
+        self.counts = collections.Counter()
+        self.next_id = 1
+        self.keys = {}
+        self.arks = {}
+        self.state = state
+        self.counts_file = counts
+        self.latency = latency / 1000.0
+        self.out = out
+        if state is not None and os.path.exists(state):
+            with open(state) as f:
+                saved = json.load(f)
+            self.arks.update(saved["arks"])
+            self.next_id = saved["next_id"]
+        atexit.register(self.save)
+
+    def new_id(self):
+        with self.lock:
+            i = self.next_id
+            self.next_id += 1
+            return i
+
+    # Count (and write out) one statement, and wait as a server would
+    def round_trip(self, sql, args=None, data=None):
+        verb = sql.split(None, 1)[0].upper()
+        m = TABLE.search(sql)
+        if verb == "WITH":
+            verb = "UPSERT"
+            m = re.search(r"INSERT INTO (\w+)", sql)
+        with self.lock:
+            self.counts[verb + " " + (m.group(1) if m else "-")] += 1
+            self.counts["round trips"] += 1
+            if self.out is not None:
+                self.out.write(mogrify(sql, args).rstrip().rstrip(u";") + u";\n")
+                if data is not None:
+                    self.out.write(data + u"\\.\n")
+        if self.latency:
+            time.sleep(self.latency)
+
+    # The rows the server would send back for a statement
+    def answer(self, sql, args):
+        rows = []
+        if sql.startswith("SELECT count(*), max(id) FROM vocabulary"):
+            rows = [(0, None)]
+        elif sql.startswith("SELECT nextval("):
+            rows = [(self.new_id(),) for n in range(args[1])]
+        elif sql.startswith("WITH ins AS"):
+            # get_or_create: the key values of the batch follow its rows
+            table = re.search(r"INSERT INTO (\w+)", sql).group(1)
+            columns = COLUMNS.search(sql).group(1).split(",")
+            key = CONFLICT.search(sql).group(1).split(",")
+            n = len(args) // (len(columns) + len(key))
+            values = args[n * len(columns):]
+            for j in range(n):
+                k = tuple([text(v) for v in values[j * len(key):(j + 1) * len(key)]])
+                with self.lock:
+                    if (table, k) not in self.keys:
+                        self.keys[(table, k)] = self.new_id()
+                    rows.append((self.keys[(table, k)],) + k)
+        elif sql.startswith("INSERT INTO") and "RETURNING id" in sql:
+            i = self.new_id()
+            if re.match(r"INSERT INTO cpf(_internal)? ", sql) and isinstance(args, dict) and args.get("ark_id") is not None:
+                i = args.get("id", i)
+                with self.lock:
+                    self.arks[text(args["ark_id"])] = i
+            rows = [(i,)]
+        elif sql.startswith("UPDATE") and "RETURNING id" in sql:
+            rows = [(int(WHERE_ID.search(sql).group(1)),)]
+        elif sql.startswith("SELECT ark_id, id FROM cpf"):
+            with self.lock:
+                rows = sorted(self.arks.items(), key=lambda item: item[0].encode("utf-8"))
+        elif sql.startswith("SELECT id FROM cpf WHERE ark_id="):
+            i = self.arks.get(text(args[0]))
+            if i is not None:
+                rows = [(i,)]
+        return rows
+
+    # Take note of the rows of a COPY
+    def copy(self, sql, data):
+        m = re.match(r"COPY (\w+) \(([^)]*)\)", sql)
+        lines = data.split(u"\n")[:-1]
+        with self.lock:
+            self.counts["COPY rows " + m.group(1)] += len(lines)
+            if m.group(1) in ("cpf", "cpf_internal"):
+                columns = m.group(2).split(",")
+                for line in lines:
+                    row = dict(zip(columns, line.split(u"\t")))
+                    if "id" in row and row.get("ark_id", u"\\N") != u"\\N":
+                        self.arks[row["ark_id"]] = int(row["id"])
+
+    def commit(self):
+        with self.lock:
+            self.counts["COMMIT"] += 1
+            if self.out is not None:
+                self.out.write(u"COMMIT;\n")
+        if self.latency:
+            time.sleep(self.latency)
+
+    def save(self):
+        with self.lock:
+            if self.out is not None:
+                self.out.flush()
+            if self.state is not None:
+                with open(self.state, "w") as f:
+                    json.dump({"arks": self.arks, "next_id": self.next_id}, f)
+            if self.counts_file is not None:
+                with open(self.counts_file, "w") as f:
+                    json.dump(dict(self.counts), f, indent=1, sort_keys=True)
+            print("Recorded", self.counts["round trips"], "round trips and", self.counts["COMMIT"], "commits", file=sys.stderr)
+
+class RecordingCursor(object):
+
+    def __init__(self, recorder, name=None):
+        self.recorder = recorder
+        self.name = name
+        self.itersize = 2000
+        self.rows = []
+        self.rowcount = 0
+
+    def execute(self, sql, args=None):
+        check_parameters(args)
+        self.recorder.round_trip(sql, args)
+        self.rows = self.recorder.answer(sql, args)
+        self.rowcount = len(self.rows)
+
+    def copy_expert(self, sql, f):
+        data = text(f.read())
+        self.recorder.round_trip(sql, data=data)
+        self.recorder.copy(sql, data)
+
+    def fetchone(self):
+        if self.rows:
+            return self.rows.pop(0)
+        return None
+
+    def fetchall(self):
+        rows = self.rows
+        self.rows = []
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        pass
+
+class RecordingConnection(object):
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.autocommit = False
+
+    def cursor(self, name=None):
+        return RecordingCursor(self.recorder, name)
+
+    def commit(self):
+        self.recorder.commit()
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+# The stand-in of this process, made on the first connect()
+recorder = None
+
+# Open a connection to the backend chosen in args
+def connect(args):
+    global recorder
+    if args.backend == "postgres":
+        import psycopg2
+        return psycopg2.connect(args.dsn)
+    if recorder is None:
+        out = None
+        if args.backend == "sql":
+            if args.sql_file is None:
+                raise SystemExit("--backend sql needs --sql-file")
+            out = io.open(args.sql_file, "w", encoding="utf-8")
+        recorder = Recorder(args.record_state, args.record_counts, args.record_latency, out)
+    return RecordingConnection(recorder)
@@ -0,0 +1,593 @@
+from __future__ import print_function
+import atexit
+import collections
+import io
+import multiprocessing
+import sys
+import time
+# Import XML parser
+import xml.etree.ElementTree as ET
+# Import the input readers
+from inputs import open_input
+
+# Shared EAC-CPF record parser
+#
+# Every importer (sql-import.py, sql-first-import.py, rel-import.py and
+# sql-data.py) reads records through this module.  Instead of splitting each
+# tag on "}" and walking a chain of string comparisons, the handlers below are
+# keyed on the fully-qualified tag names ElementTree hands back, so each
+# element costs one dictionary lookup.
+
+# Portability
+try:
+    register_namespace = ET.register_namespace
+except AttributeError:
+    def register_namespace(prefix, uri):
+        ET._namespace_map[uri] = prefix
+
+# Define the namespaces to use
+namespaces = { "snac" : "urn:isbn:1-931666-33-4" ,
+        "snac2" : "http://socialarchive.iath.virginia.edu/control/term#",
+        "schema" : "http://schema.org/",
+        "xlink" : "http://www.w3.org/1999/xlink",
+        "snac3" : "http://socialarchive.iath.virginia.edu/"}
+# Register the namespaces
+register_namespace("eac-cpf", "urn:isbn:1-931666-33-4")
+register_namespace("snac2", "http://socialarchive.iath.virginia.edu/control/term#")
+register_namespace("snac", "http://socialarchive.iath.virginia.edu/")
+register_namespace("xlink", "http://www.w3.org/1999/xlink")
+
+# Fully-qualified tag and attribute prefixes
+EAC = "{urn:isbn:1-931666-33-4}"
+XLINK = "{http://www.w3.org/1999/xlink}"
+SNAC = "{http://socialarchive.iath.virginia.edu/}"
+
+XLINK_TYPE = XLINK + "type"
+XLINK_HREF = XLINK + "href"
+XLINK_ROLE = XLINK + "role"
+XLINK_ARCROLE = XLINK + "arcrole"
+
+# Note a warning about the record being parsed (see WarningReport)
+def warning(record, *objs):
+    record.warnings.append(" ".join([("%s" % obj).strip() for obj in objs]))
+
+# Get the name of a tag
+def valueOf(tag):
+    return tag.split("}")[1][0:]
+
+# Get the value of a term
+def termOnly(term):
+    return term.split("#")[1][0:]
+
+
+# One parsed EAC-CPF record.  Each attribute holds the rows destined for the
+# table of the same name; they are filled in document order.  biogHist holds
+# the record's biogHists merged into one, serialized for cpf.biog_hist, and
+# warnings the parser's warnings about the record.
+class Record(object):
+    __slots__ = ("cpf", "names", "dates", "sources", "documents", "occupations",
+                 "places", "subjects", "nationalities", "biogHist",
+                 "cpf_otherids", "cpf_history", "cpf_relations", "warnings")
+
+    def __init__(self):
+        self.cpf = {}
+        self.names = []
+        self.dates = []
+        self.sources = []
+        self.documents = []
+        self.occupations = []
+        self.places = []
+        self.subjects = []
+        self.nationalities = []
+        self.biogHist = None
+        self.cpf_otherids = []
+        self.cpf_history = []
+        self.cpf_relations = []
+        self.warnings = []
+
+    # Records are handed between processes by the parse pool
+    def __getstate__(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+# The latest maintenanceEvent eventDateTime of a record, or None if it has none
+def latest_event(record):
+    times = [history["modified_time"] for history in record.cpf_history if history.get("modified_time")]
+    if times:
+        return max(times)
+    return None
+
+
+# Walk the children of node, handing each one to the handler registered for
+# its tag.  Tags without a handler are reported (with their path) unless the
+# caller asked for them to be skipped quietly.
+def dispatch(handlers, record, node, path, report=True):
+    for child in node:
+        handler = handlers.get(child.tag)
+        if handler is not None:
+            handler(record, child)
+        elif report:
+            warning(record, "Unknown Tag: ", *(path + (valueOf(child.tag),)))
+
+
+#
+# control
+#
+
+def _recordId(record, control):
+    record.cpf["ark_id"] = control.text
+
+def _otherRecordId(record, control):
+    record.cpf_otherids.append({'link_type': termOnly(control.get('localType')), 'other_id': control.text})
+
+def _maintenanceStatus(record, control):
+    record.cpf["maintenance_status"] = control.text
+
+def _maintenanceAgency(record, control):
+    record.cpf["maintenance_agency"] = control[0].text
+
+def _languageDeclaration(record, control):
+    record.cpf["language_code"] = control[0].get('languageCode')
+    record.cpf["script_code"] = control[1].get('scriptCode')
+
+def _conventionDeclaration(record, control):
+    record.cpf["conven_dec_citation"] = control[0].text
+
+# maintenanceEvent children and the cpf_history column they fill
+MAINTENANCE_EVENT = {
+    EAC + "eventType": "event_type",
+    EAC + "eventDateTime": "modified_time",
+    EAC + "agentType": "agent_type",
+    EAC + "agent": "agent",
+    EAC + "eventDescription": "description",
+}
+
+def _maintenanceHistory(record, control):
+    for maint_event in control:
+        # handle each event individually
+        maint_history = {}
+        if maint_event.tag == EAC + "maintenanceEvent":
+            for maint_part in maint_event:
+                column = MAINTENANCE_EVENT.get(maint_part.tag)
+                if column is not None:
+                    maint_history[column] = maint_part.text
+                else:
+                    warning(record, "Unknown Tag: ", "control", "maintenanceHistory", "maintenanceEvent", valueOf(maint_part.tag))
+        else:
+            warning(record, "Unknown Tag: ", "control", "maintenanceHistory", valueOf(maint_event.tag))
+        record.cpf_history.append(maint_history)
+
+def _sources(record, control):
+    for source in control:
+        # TODO: what about the full text of the source?
+        record.sources.append({'source_type': source.get(XLINK_TYPE), 'href': source.get(XLINK_HREF)})
+
+CONTROL = {
+    EAC + "recordId": _recordId,
+    EAC + "otherRecordId": _otherRecordId,
+    EAC + "maintenanceStatus": _maintenanceStatus,
+    EAC + "maintenanceAgency": _maintenanceAgency,
+    EAC + "languageDeclaration": _languageDeclaration,
+    EAC + "conventionDeclaration": _conventionDeclaration,
+    EAC + "maintenanceHistory": _maintenanceHistory,
+    EAC + "sources": _sources,
+}
+
+def _control(record, node):
+    dispatch(CONTROL, record, node, ("control",))
+
+
+#
+# cpfDescription/identity
+#
+
+def _entityType(record, ident):
+    record.cpf["entity_type"] = ident.text
+
+# nameEntry children that name the contributor of the name
+NAME_CONTRIBUTORS = {
+    EAC + "authorizedForm": "authorizedForm",
+    EAC + "alternativeForm": "alternativeForm",
+}
+
+def _nameEntry(record, ident):
+    # convention: first name in the name table is the preferred name
+    # language, preference_score, authorized_form,original, corporate_name,
+    # contributor[{contributor, name_type}]
+    name = {}
+    name_contrib = []
+    name["preference_score"] = ident.get(SNAC + "preferenceScore")
+    for name_part in ident:
+        if name_part.tag == EAC + "part":
+            name["original"] = name_part.text
+        elif name_part.tag in NAME_CONTRIBUTORS:
+            name_contrib.append({"contributor": name_part.text, "name_type": NAME_CONTRIBUTORS[name_part.tag]})
+        else:
+            warning(record, "Unknown Tag: ", "cpfDescription", "identity", "nameEntry", valueOf(name_part.tag))
+    name["contributor"] = name_contrib
+    record.names.append(name)
+
+IDENTITY = {
+    EAC + "entityType": _entityType,
+    EAC + "nameEntry": _nameEntry,
+}
+
+def _identity(record, desc):
+    dispatch(IDENTITY, record, desc, ("cpfDescription", "identity"))
+
+
+#
+# cpfDescription/description
+#
+
+# Fill the from_/to_ half of a date row from a fromDate or toDate element,
+# moving a leading "-" on the standard date into the _bc flag
+def _rangeEnd(date, prefix, edate):
+    stddate = edate.get("standardDate")
+    if stddate[:1] == "-":
+        date[prefix + "_bc"] = True
+        stddate = stddate[1:]
+    date[prefix + "_date"] = stddate
+    date[prefix + "_original"] = edate.text
+    date[prefix + "_type"] = termOnly(edate.get("localType"))
+
+def _dateRange(record, edates):
+    date = {}
+    date["is_range"] = True
+    if edates[0].tag == EAC + "fromDate":
+        if edates[0].text is not None:
+            _rangeEnd(date, "from", edates[0])
+        if len(edates) > 1 and edates[1].tag == EAC + "toDate" and edates[1].text is not None:
+            _rangeEnd(date, "to", edates[1])
+    elif edates[0].tag == EAC + "toDate":
+        if edates[0].text is not None:
+            _rangeEnd(date, "to", edates[0])
+    else:
+        warning(record, "Unknown Tag: ", "cpfDescription", "description", "existDates", "dateRange", valueOf(edates[0].tag))
+    record.dates.append(date)
+
+def _date(record, edates):
+    date = {}
+    date["is_range"] = False
+    date["from_date"] = edates.get("standardDate")
+    date["from_original"] = edates.text
+    date["from_type"] = termOnly(edates.get("localType"))
+    record.dates.append(date)
+
+EXIST_DATES = {
+    EAC + "dateRange": _dateRange,
+    EAC + "date": _date,
+}
+
+def _existDates(record, description):
+    dispatch(EXIST_DATES, record, description, ("cpfDescription", "description", "existDates"))
+
+def _place(record, description):
+    #TODO Handle place tags and snac:placeEntry items
+    pass
+
+# Any term after the first in a single-term element is unexpected
+def _extraTerms(record, description):
+    if len(description) > 1:
+        warning(record, "Unknown Tag: ", "cpfDescription", "description", valueOf(description.tag), valueOf(description[1].tag))
+
+def _associatedSubject(record, description):
+    record.subjects.append(description[0].text)
+    _extraTerms(record, description)
+
+def _nationalityOfEntity(record, description):
+    record.nationalities.append(description[0].text)
+    _extraTerms(record, description)
+
+def _gender(record, description):
+    record.cpf["gender"] = description[0].text
+    _extraTerms(record, description)
+
+# localDescription handlers, keyed on the term of their localType
+LOCAL_DESCRIPTION = {
+    "AssociatedSubject": _associatedSubject,
+    "nationalityOfEntity": _nationalityOfEntity,
+    "gender": _gender,
+}
+
+def _localDescription(record, description):
+    handler = LOCAL_DESCRIPTION.get(termOnly(description.get("localType")))
+    if handler is not None:
+        handler(record, description)
+    else:
+        warning(record, "Unknown Attribute: ", "cpfDescription", "description", "localDescription", "localType = ", description.get("localType"))
+
+def _languageUsed(record, description):
+    for lang in description:
+        if lang.tag == EAC + "language":
+            record.cpf["language_used"] = lang.get("languageCode")
+        elif lang.tag == EAC + "script":
+            record.cpf["script_used"] = lang.get("scriptCode")
+        else:
+            warning(record, "Unknown Tag: ", "cpfDescription", "description", "languageUsed", valueOf(lang.tag))
+
+def _occupation(record, description):
+    record.occupations.append(description[0].text)
+    _extraTerms(record, description)
+
+# Every biogHist of a record is merged into one: a copy of the first, without
+# its tail, that takes the children of each in turn.  The merged element is
+# serialized once the whole record is parsed, see _finish().
+def _biogHist(record, description):
+    if record.biogHist is None:
+        record.biogHist = ET.Element(description.tag, description.attrib)
+        record.biogHist.text = description.text
+    record.biogHist.extend(list(description))
+
+DESCRIPTION = {
+    EAC + "existDates": _existDates,
+    EAC + "place": _place,
+    EAC + "localDescription": _localDescription,
+    EAC + "languageUsed": _languageUsed,
+    EAC + "occupation": _occupation,
+    EAC + "biogHist": _biogHist,
+}
+
+def _description(record, desc):
+    # Description elements we do not handle yet are skipped without a warning
+    dispatch(DESCRIPTION, record, desc, ("cpfDescription", "description"), report=False)
+
+
+#
+# cpfDescription/relations
+#
+
+def _cpfRelation(record, rel):
+    relation = {}
+    if len(rel) > 1:
+        warning(record, "Unknown Tag: ", "cpfDescription", "relations", "cpfRelation", valueOf(rel[1].tag))
+    relation["relation_type"] = termOnly(rel.get(XLINK_ARCROLE))
+    relation["relation_ark_id"] = rel.get(XLINK_HREF)
+    relation["relation_other_type"] = termOnly(rel.get(XLINK_ROLE))
+    if len(rel) > 0:
+        relation["relation_entry"] = rel[0].text
+    else:
+        relation["relation_entry"] = ""
+    record.cpf_relations.append(relation)
+
+# Wrapped XML and notes are kept as text, serialized as the biogHist is
+def _resourceRelation(record, rel):
+    relation = {}
+    relation["document_role"] = termOnly(rel.get(XLINK_ARCROLE))
+    relation["href"] = rel.get(XLINK_HREF)
+    relation["document_type"] = termOnly(rel.get(XLINK_ROLE))
+    relation["link_type"] = rel.get(XLINK_TYPE)
+    for relitem in rel:
+        if relitem.tag == EAC + "relationEntry":
+            relation["name"] = relitem.text
+        elif relitem.tag == EAC + "objectXMLWrap":
+            relation["xml_source"] = ET.tostring(relitem).decode("ascii")
+        elif relitem.tag == EAC + "descriptiveNote":
+            relation["notes"] = ET.tostring(relitem).decode("ascii")
+        else:
+            warning(record, "Unknown Tag: ", "cpfDescription", "relations", "resourceRelation", valueOf(relitem.tag))
+    record.documents.append(relation)
+
+RELATIONS = {
+    EAC + "cpfRelation": _cpfRelation,
+    EAC + "resourceRelation": _resourceRelation,
+}
+
+def _relations(record, desc):
+    dispatch(RELATIONS, record, desc, ("cpfDescription", "relations"))
+
+
+#
+# Record root
+#
+
+CPF_DESCRIPTION = {
+    EAC + "identity": _identity,
+    EAC + "description": _description,
+    EAC + "relations": _relations,
+}
+
+def _cpfDescription(record, node):
+    dispatch(CPF_DESCRIPTION, record, node, ("cpfDescription",))
+
+ROOT = {
+    EAC + "control": _control,
+    EAC + "cpfDescription": _cpfDescription,
+}
+
+# Parse an already loaded eac-cpf root element into a Record.  Any tag missing
+# from the tables above is reported to the warning function, so we can keep
+# track of all problematic or missing tags from the schema.
+def parse_root(root):
+    record = Record()
+    dispatch(ROOT, record, root, ())
+    return _finish(record)
+
+# Serialize the merged biogHist, as the cpf.biog_hist column holds it: text,
+# not the ASCII bytes tostring() gives on Python 3
+def _finish(record):
+    if record.biogHist is not None:
+        record.biogHist = ET.tostring(record.biogHist).decode("ascii")
+    return record
+
+
+
+#
+# Streaming
+#
+# iterparse() builds the same Record as parse_root() without ever holding the
+# whole tree.  Each child of control, identity, description and relations is
+# handed to its handler as soon as it is complete and is then dropped from
+# its parent, so memory stays flat however many resourceRelations (or however
+# large a biogHist) a record carries.
+
+# Containers that were already handled child by child only check for unknowns
+def _streamed(record, node):
+    pass
+
+# Streaming levels: (handlers, warning path, report unknown tags, child levels)
+STREAM_IDENTITY = (IDENTITY, ("cpfDescription", "identity"), True, {})
+STREAM_DESCRIPTION = (DESCRIPTION, ("cpfDescription", "description"), False, {})
+STREAM_RELATIONS = (RELATIONS, ("cpfDescription", "relations"), True, {})
+STREAM_CPF_DESCRIPTION = (dict.fromkeys(CPF_DESCRIPTION, _streamed), ("cpfDescription",), True, {
+    EAC + "identity": STREAM_IDENTITY,
+    EAC + "description": STREAM_DESCRIPTION,
+    EAC + "relations": STREAM_RELATIONS,
+})
+STREAM_CONTROL = (CONTROL, ("control",), True, {})
+STREAM_ROOT = (dict.fromkeys(ROOT, _streamed), (), True, {
+    EAC + "control": STREAM_CONTROL,
+    EAC + "cpfDescription": STREAM_CPF_DESCRIPTION,
+})
+
+# Hand one finished child to its level's handler, then detach it
+def _stream_child(record, level, child, parent):
+    handler = level[0].get(child.tag)
+    if handler is not None:
+        handler(record, child)
+    elif level[2]:
+        warning(record, "Unknown Tag: ", *(level[1] + (valueOf(child.tag),)))
+    parent.remove(child)
+
+# Parse one EAC-CPF file incrementally into a Record
+def iterparse(source):
+    record = Record()
+    # open elements, each with the streaming level its children belong to
+    stack = []
+    pending = None
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        # A finished child is only handled once the next event arrives, so
+        # that its tail text has been read (ET.tostring includes it)
+        if pending is not None:
+            _stream_child(record, *pending)
+            pending = None
+        if event == "start":
+            if not stack:
+                stack.append((elem, STREAM_ROOT))
+            else:
+                parent_level = stack[-1][1]
+                stack.append((elem, parent_level[3].get(elem.tag) if parent_level is not None else None))
+            continue
+        stack.pop()
+        if stack and stack[-1][1] is not None:
+            pending = (stack[-1][1], elem, stack[-1][0])
+    if pending is not None:
+        _stream_child(record, *pending)
+    return _finish(record)
+
+# Parse one EAC-CPF file (a filename or file object) into a Record, either
+# from a fully built tree or incrementally with iterparse()
+def parse(source, stream=False):
+    if stream:
+        return iterparse(source)
+    return parse_root(ET.parse(source).getroot())
+
+# Parse one input, from its data if it has been read already (see inputs.py),
+# else from the file it names, decompressed or memory-mapped as it is read
+def parse_input(name, data, stream=False):
+    if data is not None:
+        return parse(io.BytesIO(data), stream)
+    f = open_input(name)
+    try:
+        return parse(f, stream)
+    finally:
+        f.close()
+
+# Parse every input of entries, (name, data) pairs, yielding (name, Record)
+# pairs in input order.  With more than one worker the inputs are parsed by a
+# pool of processes while the caller, the single database writer, applies the
+# records as they arrive.  Only a few records per worker are parsed ahead of
+# the writer, so a slow database does not pile parsed records up in memory.
+def parse_all(entries, stream=False, workers=1):
+    if workers <= 1:
+        for name, data in entries:
+            yield name, parse_input(name, data, stream)
+        return
+    # The importers are plain scripts without a __main__ guard, so the workers
+    # must be forked rather than spawned (which would re-run the script)
+    try:
+        pool = multiprocessing.get_context("fork").Pool(workers)
+    except AttributeError:
+        pool = multiprocessing.Pool(workers)
+    try:
+        pending = collections.deque()
+        for name, data in entries:
+            pending.append((name, pool.apply_async(parse_input, (name, data, stream))))
+            if len(pending) >= workers * 4:
+                name, result = pending.popleft()
+                yield name, result.get()
+        while pending:
+            name, result = pending.popleft()
+            yield name, result.get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+#
+# Warnings
+#
+# The parser notes its warnings (unknown tags and attributes, with their path)
+# on each record instead of printing them, so that parsing in worker processes
+# costs no writes.  The importers hand every parsed record to report, which
+# counts the warnings by message, keeping the first few ark_ids of each, and
+# writes a summary to standard error at exit (and every --warnings-every
+# seconds).  With --verbose each record's "Parsing:" line and warnings are
+# written as well, as they used to be.
+class WarningReport(object):
+
+    def __init__(self, samples=3):
+        self.counts = collections.Counter()
+        self.samples = {}
+        self.sample_size = samples
+        self.records = 0
+        self.verbose = False
+        self.interval = 0
+        self.last = time.time()
+
+    def install(self, args):
+        self.verbose = args.verbose
+        self.interval = args.warnings_every
+        atexit.register(self.summary)
+
+    # Take note of one parsed record
+    def parsed(self, name, record):
+        if self.verbose:
+            print("Parsing: ", name, file=sys.stderr)
+            for message in record.warnings:
+                print("WARN: ", message, file=sys.stderr)
+        if record.warnings:
+            self.records += 1
+            ark = record.cpf.get("ark_id") or name
+            for message in record.warnings:
+                self.counts[message] += 1
+                samples = self.samples.setdefault(message, [])
+                if len(samples) < self.sample_size and ark not in samples:
+                    samples.append(ark)
+        if self.interval and time.time() - self.last >= self.interval:
+            self.summary()
+            self.last = time.time()
+
+    def summary(self):
+        if not self.counts:
+            return
+        print("Warnings:", sum(self.counts.values()), "in", self.records, "records", file=sys.stderr)
+        for message, n in sorted(self.counts.items(), key=lambda item: (-item[1], item[0])):
+            print("%10d  %s  (e.g. %s)" % (n, message, ", ".join(self.samples[message])), file=sys.stderr)
+
+report = WarningReport()
+
+# Register the parser options shared by every importer
+def add_arguments(parser):
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="write a line for every record parsed (and imported), and every warning, as they happen")
+    parser.add_argument("--warnings-every", type=float, default=0, metavar="SECONDS",
+                        help="also write the warning summary every SECONDS seconds (default: %(default)s, only at exit)")
+    parser.add_argument("--stream", action="store_true",
+                        help="parse records incrementally, clearing each element once handled (flat memory on very large records)")
+    parser.add_argument("--workers", type=int, default=1, metavar="N",
+                        help="parse records in N processes, feeding the single database writer in input order (default: %(default)s)")
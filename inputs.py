@@ -0,0 +1,259 @@
+from __future__ import print_function
+import bz2
+import gzip
+import mmap
+import os
+import re
+import sys
+import tarfile
+import threading
+import zipfile
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+# Input sources for the importers.
+#
+# Each input the importers are given is one of:
+#
+#   a directory       walked (in sorted order) for its .xml files
+#   a tar archive     .tar, .tar.gz, .tgz, .tar.bz2, .tbz2, .tar.xz or .txz,
+#                     read as a stream for its .xml members, named
+#                     ARCHIVE/MEMBER
+#   a zip archive     .zip, for its .xml members, named ARCHIVE/MEMBER
+#   an EAC-CPF file   a file starting with "<": one record, or a collection
+#                     of records written one after the other, named FILE#1,
+#                     FILE#2, ...
+#   a file list       anything else: one EAC-CPF filename per line, as before
+#                     ("-", or no inputs at all, reads the list from
+#                     standard input)
+#
+# Files ending in .gz, .bz2 or .xz (EAC-CPF files, collections, file lists,
+# and the files listed or found in a directory) are decompressed as they are
+# read, and any other file is memory-mapped rather than read through a
+# buffered file object.
+#
+# entries() yields a (name, data) pair for each EAC-CPF record, in order.  The
+# data of archive members and collection records is read along the way; that
+# of a listed or walked file is None until read_ahead() reads it, in a thread
+# of its own and up to --read-ahead files ahead, so the parser does not wait
+# on the disk.  Journal.skip() is applied before read_ahead(), so the files a
+# resumed job skips are never read.
+
+XML = ".xml"
+COMPRESSED = (".gz", ".bz2", ".xz")
+TAR = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+ZIP = (".zip",)
+
+# Register the input options, shared by the importers
+def add_arguments(parser):
+    parser.add_argument("inputs", nargs="*", help="EAC-CPF inputs: files listing one EAC-CPF filename per line, directories, tar or zip archives, or EAC-CPF files holding one or more records (default: a file list on standard input)")
+    parser.add_argument("--read-ahead", type=int, default=64, metavar="N", help="read up to N files ahead of the parser in a background thread (default: %(default)s, 0 for none)")
+
+# The name of an entry
+def name(entry):
+    return entry[0]
+
+# Open a file for reading its bytes: through a decompressor if its name ends
+# in .gz, .bz2 or .xz, else mapped into memory (empty files, which cannot be
+# mapped, are opened as usual)
+def open_input(filename):
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "rb")
+    if filename.endswith(".bz2"):
+        return bz2.BZ2File(filename)
+    if filename.endswith(".xz"):
+        if lzma is None:
+            raise IOError("reading %s needs the lzma module (Python 3)" % filename)
+        return lzma.open(filename)
+    f = open(filename, "rb")
+    try:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError):
+        return f
+    f.close()
+    return mapped
+
+def read_file(filename):
+    f = open_input(filename)
+    try:
+        if isinstance(f, mmap.mmap):
+            return f[:]
+        return f.read()
+    finally:
+        f.close()
+
+# The EAC-CPF files listed in a file list, one per line
+def listed(f):
+    for line in iter(f.readline, f.read(0)):
+        if not isinstance(line, str):
+            line = line.decode("utf-8")
+        line = line.strip()
+        if line:
+            yield line, None
+
+def is_record_file(filename):
+    if filename.endswith(COMPRESSED):
+        filename = filename.rsplit(".", 1)[0]
+    return filename.endswith(XML)
+
+def walk(directory):
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for filename in sorted(files):
+            if is_record_file(filename):
+                yield os.path.join(root, filename), None
+
+def tar_members(filename):
+    tar = tarfile.open(filename, "r|*")
+    try:
+        for member in tar:
+            if member.isfile() and member.name.endswith(XML):
+                yield filename + "/" + member.name, tar.extractfile(member).read()
+    finally:
+        tar.close()
+
+def zip_members(filename):
+    archive = zipfile.ZipFile(filename)
+    try:
+        for info in archive.infolist():
+            if info.filename.endswith(XML):
+                yield filename + "/" + info.filename, archive.read(info)
+    finally:
+        archive.close()
+
+# The records of a collection are cut apart after each closing eac-cpf tag,
+# each from its opening tag, or from the XML declaration before that when
+# nothing but white space lies between them, so anything else between the
+# records (such as the tags of a wrapping element) is dropped
+RECORD_OPEN = re.compile(br"<(?:[\w.-]+:)?eac-cpf[\s>]")
+RECORD_END = re.compile(br"</(?:[\w.-]+:)?eac-cpf\s*>")
+DECLARATION = re.compile(br"<\?xml[^>]*\?>\s*$")
+# What a closing eac-cpf tag cut off by the end of the buffer may look like
+RECORD_END_START = re.compile(br"<(?:/[\w.:-]*\s*)?\Z")
+
+def record_start(buf, pos, endpos):
+    opening = RECORD_OPEN.search(buf, pos, endpos)
+    if opening is None:
+        return None
+    declaration = buf.rfind(b"<?xml", pos, opening.start())
+    if declaration >= 0 and DECLARATION.match(buf, declaration, opening.start()):
+        return declaration
+    return opening.start()
+
+def collection(f, filename, blocksize=1 << 20):
+    n = 0
+    buf = bytearray()
+    scan = 0
+    while True:
+        block = f.read(blocksize)
+        buf += block
+        pos = 0
+        while True:
+            end = RECORD_END.search(buf, scan)
+            if end is None:
+                break
+            start = record_start(buf, pos, end.start())
+            if start is not None:
+                n += 1
+                yield "%s#%d" % (filename, n), bytes(buf[start:end.end()])
+            pos = scan = end.end()
+        # A closing tag cut off by the end of the buffer starts at its only
+        # "<", so the next search starts at the last one, if a closing tag
+        # could start there, and otherwise at the new block
+        last = buf.rfind(b"<", scan)
+        if last >= 0 and RECORD_END_START.match(buf, last):
+            scan = last
+        else:
+            scan = len(buf)
+        del buf[:pos]
+        scan -= pos
+        if not block:
+            break
+    # A record left without its closing tag goes to the parser, to fail there
+    start = record_start(buf, 0, len(buf))
+    if start is not None:
+        yield "%s#%d" % (filename, n + 1), bytes(buf[start:])
+
+# The recordId of an unparsed EAC-CPF record, if it can be read off its bytes
+# as the parser would read it: plain ASCII text without entities or CDATA
+RECORD_ID = re.compile(br"<(?:[\w.-]+:)?recordId>([^<&\r\x80-\xff]*)</(?:[\w.-]+:)?recordId>")
+
+def record_id(data):
+    m = RECORD_ID.search(data)
+    if m is None:
+        return None
+    return m.group(1).decode("ascii")
+
+# Whether a file holds EAC-CPF (rather than a list of filenames): its first
+# character, after any byte order mark and white space, is "<"
+def is_xml(f):
+    head = f.read(512).lstrip(b"\xef\xbb\xbf").lstrip()
+    f.seek(0)
+    return head.startswith(b"<")
+
+# The entries of one input
+def expand(path):
+    if path == "-":
+        return listed(sys.stdin)
+    if os.path.isdir(path):
+        return walk(path)
+    if path.endswith(TAR):
+        return tar_members(path)
+    if path.endswith(ZIP):
+        return zip_members(path)
+    return from_file(path)
+
+def from_file(path):
+    f = open_input(path)
+    try:
+        if is_xml(f):
+            entries = collection(f, path)
+        else:
+            entries = listed(f)
+        for entry in entries:
+            yield entry
+    finally:
+        f.close()
+
+# The entries of all the inputs, in order
+def entries(paths):
+    for path in paths or ["-"]:
+        for entry in expand(path):
+            yield entry
+
+# Read the data of the entries in a background thread, up to depth entries
+# ahead of the caller.  An error reading an input is raised to the caller.
+DONE = object()
+
+def read_ahead(entries, depth):
+    if depth <= 0:
+        for entry in entries:
+            yield entry
+        return
+    ready = queue.Queue(depth)
+    def run():
+        try:
+            for filename, data in entries:
+                if data is None:
+                    data = read_file(filename)
+                ready.put((filename, data))
+        except Exception:
+            ready.put((DONE, sys.exc_info()[1]))
+            return
+        ready.put((DONE, None))
+    reader = threading.Thread(target=run, name="read-ahead")
+    reader.daemon = True
+    reader.start()
+    while True:
+        filename, data = ready.get()
+        if filename is DONE:
+            if data is not None:
+                raise data
+            break
+        yield filename, data
@@ -12,12 +12,19 @@
 --      ...         ...         ...
 --
 -- 4. Organized as follows:
---      A. Sequence definitions
+--      A. Sequence and function definitions
 --      B. Main tables
 --      C. Join/Link tables
+--      D. Import bookkeeping
+-- 5. Plain (non-unique) indexes are only needed for reading, and are dropped
+--    before a bulk load and built again after it by sql-indexes.py.  Unique
+--    indexes stay, as the importers find shared rows by them.
+-- 6. Every versioned table X_internal holds all the versions of its rows, and
+--    is read through X, a table of the current version of each row (see
+--    current_table below), so reads and lookups need no sort per query.
 
 --
--- A. Sequences
+-- A. Sequences and Functions
 --
 
 -- Sequence for unique cpf IDs
@@ -53,6 +60,78 @@ CREATE SEQUENCE "version_history_id_seq"
     NO MAXVALUE
     CACHE 1;
 
+-- Current versions.  current_table('x') makes table x, with the columns of
+-- x_internal, for the current version of each x_internal row: the one with
+-- the highest version, or the row as the importers wrote it into x.  A
+-- trigger on x_internal moves every newer version into x as it is written;
+-- refresh_current('x') does the same for all of x_internal at once (say,
+-- after versions were loaded with the triggers disabled), and
+-- refresh_current() for every such table.  Both return the number of rows
+-- they wrote into the current tables: one for each row that was not current.
+-- A row the importers wrote into x has no version in x_internal, so before a
+-- newer version replaces it, it is copied into x_internal as version 0 and
+-- so kept in the history.
+create or replace function current_version() returns trigger as $$
+declare
+    entity text := substring(TG_TABLE_NAME from '^(.*)_internal$');
+    latest int;
+begin
+    -- Fired again by the copy of an imported row below, which is current already
+    if pg_trigger_depth() > 1 then
+        return null;
+    end if;
+    execute format('select version from %I where id = $1', entity) into latest using NEW.id;
+    if latest > NEW.version then
+        return null;
+    end if;
+    execute format('update %I set version = 0 where id = $1 and version is null', entity) using NEW.id;
+    execute format('insert into %2$I select * from %1$I c where c.id = $1 '
+                   'and not exists (select 1 from %2$I v where v.id = c.id and v.version = c.version)', entity, TG_TABLE_NAME) using NEW.id;
+    execute format('delete from %I where id = $1', entity) using NEW.id;
+    execute format('insert into %I select ($1).*', entity) using NEW;
+    return null;
+end;
+$$ language plpgsql;
+
+create or replace function current_table(entity text) returns void as $$
+begin
+    execute format('create table %I (like %I including defaults, primary key (id))', entity, entity || '_internal');
+    execute format('alter table %I alter column version drop not null', entity);
+    execute format('create trigger %I after insert or update on %I for each row execute procedure current_version()',
+                   entity || '_current', entity || '_internal');
+end;
+$$ language plpgsql;
+
+create or replace function refresh_current(entity text) returns bigint as $$
+declare
+    moved bigint;
+begin
+    execute format('update %1$I c set version = 0 where c.version is null '
+                   'and exists (select 1 from %2$I v where v.id = c.id)', entity, entity || '_internal');
+    execute format('insert into %2$I select * from %1$I c where exists (select 1 from %2$I v where v.id = c.id) '
+                   'and not exists (select 1 from %2$I v where v.id = c.id and v.version = c.version)', entity, entity || '_internal');
+    execute format('delete from %1$I c using (select id, max(version) as version from %2$I group by id) v '
+                   'where c.id = v.id and (c.version is null or c.version < v.version)', entity, entity || '_internal');
+    execute format('insert into %1$I select distinct on (id) * from %2$I v '
+                   'where not exists (select 1 from %1$I c where c.id = v.id) order by id asc, version desc', entity, entity || '_internal');
+    get diagnostics moved = row_count;
+    return moved;
+end;
+$$ language plpgsql;
+
+create or replace function refresh_current() returns bigint as $$
+declare
+    entity text;
+    moved bigint := 0;
+begin
+    for entity in select substring(tgname from '^(.*)_current$') from pg_trigger
+                  where tgname like '%\_current' and tgfoid = 'current_version'::regproc loop
+        moved := moved + refresh_current(entity);
+    end loop;
+    return moved;
+end;
+$$ language plpgsql;
+
 
 --
 -- B. Main Tables
@@ -80,7 +159,7 @@ create table split_merge_history (
 create table cpf_internal (                      -- Describes one EAC-CPF record
 -------------------
     id                  int                 default nextval('cpf_id_seq'),
-    version             int,                -- fk to version_history.id, sequence is unique foreign key
+    version             int                 default 0,     -- fk to version_history.id, sequence is unique foreign key; 0 as imported
     ark_id              text                unique,        -- control/cpfId
     name_id             int,                               -- (fk -> name.id) -- for convenience
     entity_type         int                 not null,      -- (fk -> vocabulary.id) -- record language
@@ -93,11 +172,9 @@ create table cpf_internal (                      -- Describes one EAC-CPF record
     conven_dec_citation text,               -- from control/conventionDeclaration/citation (currently just VIAF)
     maintenance_agency  text,
     maintenance_status  int,                -- (fk -> vocabulary.id) 
-    valid               boolean,            -- Whether or not this is a valid CPF record
+    valid               boolean             default true,  -- Whether or not this is a valid CPF record
                                             primary key (id, version));
 
-create unique index cpf_ark_idx on cpf (ark_id);
-
 create view cpf as select * from cpf_internal where valid = true; 
 
 create table name_internal (
@@ -118,7 +195,8 @@ create table name_internal (
     additional_parts    text,
                                             primary key(id, version));
 
-create view name as select distinct on (id) * from name_internal order by id asc, version desc; 
+select current_table('name');
+create index name_cpf_idx on name (cpf_id);
 
 create table dates_internal (
 ---------------------
@@ -136,7 +214,8 @@ create table dates_internal (
     is_range            boolean             default false, -- if the date is not a range, then from_date will have the only date information
                                             primary key(id, version));
 
-create view dates as select distinct on (id) * from dates_internal order by id asc, version desc; 
+select current_table('dates');
+create index dates_cpf_idx on dates (cpf_id);
 
 create table document_internal (
 -------------------------
@@ -148,8 +227,8 @@ create table document_internal (
     xml_source          text,               -- from objectXMLWrap
                                             primary key(id, version));
 
+select current_table('document');
 create unique index document_href_idx on document (href);
-create view document as select distinct on (id) * from document_internal order by id asc, version desc; 
 
 create table nationality_internal (             
 -------------------------
@@ -158,8 +237,8 @@ create table nationality_internal (
     nationality         text,               -- string of the nationality
                                             primary key(id, version));
 
+select current_table('nationality');
 create unique index nationality_idx on nationality (nationality);
-create view nationality as select distinct on (id) * from nationality_internal order by id asc, version desc; 
 
 create table place_internal (
 ----------------------
@@ -173,7 +252,7 @@ create table place_internal (
     geonames_id         text,
                                             primary key(id, version));
 
-create view place as select distinct on (id) * from place_internal order by id asc, version desc; 
+select current_table('place');
 
 
 create table source_internal (
@@ -185,10 +264,9 @@ create table source_internal (
     object_xml          text,
                                             primary key(id, version));
 
+select current_table('source');
 create unique index source_href_idx on source (href);
 
-create view source as select distinct on (id) * from source_internal order by id asc, version desc; 
-
 
 create table contributor_internal (         -- Contributors of data (VIAF, LC, WorldCat, etc)
 ---------------------------
@@ -197,10 +275,9 @@ create table contributor_internal (         -- Contributors of data (VIAF, LC, W
     short_name          text,               -- short name of the contributing entity (VIAF, LC, WorldCat, NLA, etc)
                                             primary key(id, version));
 
+select current_table('contributor');
 create unique index contributor_idx on contributor (short_name);
 
-create view contributor as select distinct on (id) * from contributor_internal order by id asc, version desc; 
-
 create table vocabulary (                   -- Controlled Vocabulary
 --------------------------------
     id                  int                 primary key default nextval('vocabulary_id_seq'),
@@ -208,7 +285,7 @@ create table vocabulary (                   -- Controlled Vocabulary
     value               text);              -- Values the vocab may take
 
 create unique index vocabulary_idx on vocabulary(id);
-create index vocabulary_type_idx on vocabulary(type);
+create unique index vocabulary_type_value_idx on vocabulary(type, value);
 create index vocabulary_value_idx on vocabulary(value);
 
 --
@@ -224,17 +301,19 @@ create table cpf_otherids_internal (
     link_type           int,                -- (fk -> vocabulary.id) -- type of link (right now, only MergedRecord)
                                             primary key(id, version));
 
-create view cpf_otherids as select distinct on (id) * from cpf_otherids_internal order by id asc, version desc; 
+select current_table('cpf_otherids');
+create index cpf_otherids_cpf_idx on cpf_otherids (cpf_id);
 
 create table cpf_sources_internal (
 ----------------------------
     id                  int                 default nextval('unique_id_seq'),
     version             int,                -- fk to version_history.id, sequence is unique foreign key
     cpf_id              int,                -- (fk -> cpf.id)
-    source_id           int,                -- (fk -> control_sources.id)
+    source_id           int,                -- (fk -> source.id)
                                             primary key(id, version));
 
-create view cpf_sources as select distinct on (id) * from cpf_sources_internal order by id asc, version desc; 
+select current_table('cpf_sources');
+create index cpf_sources_cpf_idx on cpf_sources (cpf_id);
 
 create table cpf_history_internal (
 ----------------------------
@@ -249,7 +328,8 @@ create table cpf_history_internal (
     diff                text,               -- keep the diff if we want to undo changes
                                             primary key(id, version));
 
-create view cpf_history as select distinct on (id) * from cpf_history_internal order by id asc, version desc; 
+select current_table('cpf_history');
+create index cpf_history_cpf_idx on cpf_history (cpf_id);
 
 create table cpf_occupation_internal (
 -----------------------------
@@ -259,7 +339,8 @@ create table cpf_occupation_internal (
     occupation_id       int,                -- (fk -> vocabulary.id)
                                             primary key(id, version));
 
-create view cpf_occupation as select distinct on (id) * from cpf_occupation_internal order by id asc, version desc; 
+select current_table('cpf_occupation');
+create index cpf_occupation_cpf_idx on cpf_occupation (cpf_id);
 
 create table cpf_relations_internal (
 -----------------------------
@@ -273,7 +354,9 @@ create table cpf_relations_internal (
     notes               text,               -- descriptive note.
                                             primary key(id, version));
 
-create view cpf_relations as select distinct on (id) * from cpf_relations_internal order by id asc, version desc; 
+select current_table('cpf_relations');
+create index cpf_relations_cpf1_idx on cpf_relations (cpf_id1);
+create index cpf_relations_cpf2_idx on cpf_relations (cpf_id2);
 
 create table cpf_place_internal (
 ----------------------------
@@ -286,7 +369,8 @@ create table cpf_place_internal (
     confidence          int,                -- from snac place entry
                                             primary key(id, version));
 
-create view cpf_place as select distinct on (id) * from cpf_place_internal order by id asc, version desc; 
+select current_table('cpf_place');
+create index cpf_place_cpf_idx on cpf_place (cpf_id);
 
 create table cpf_function_internal (
 ----------------------------
@@ -297,7 +381,8 @@ create table cpf_function_internal (
     function_type       int,                -- (fk -> vocabulary.id) -- might be null, could be "DerivedFromRole"
                                             primary key(id, version));
 
-create view cpf_function as select distinct on (id) * from cpf_function_internal order by id asc, version desc; 
+select current_table('cpf_function');
+create index cpf_function_cpf_idx on cpf_function (cpf_id);
 
 create table cpf_document_internal (
 -----------------------------
@@ -310,17 +395,20 @@ create table cpf_document_internal (
     notes               text,               -- descriptive note.
                                             primary key(id, version));
 
-create view cpf_document as select distinct on (id) * from cpf_document_internal order by id asc, version desc; 
+select current_table('cpf_document');
+create index cpf_document_cpf_idx on cpf_document (cpf_id);
+create index cpf_document_document_idx on cpf_document (document_id);
 
 create table cpf_nationality_internal (
 ------------------------------
     id                  int                 default nextval('unique_id_seq'),
     version             int,                -- fk to version_history.id, sequence is unique foreign key
     cpf_id              int,                -- (fk -> cpf.id)
-    nationality_id      int,                -- (fk -> nationality.id)
+    nationality_id      int,                -- (fk -> vocabulary.id)
                                             primary key(id, version));
 
-create view cpf_nationality as select distinct on (id) * from cpf_nationality_internal order by id asc, version desc; 
+select current_table('cpf_nationality');
+create index cpf_nationality_cpf_idx on cpf_nationality (cpf_id);
 
 create table cpf_subject_internal (
 ------------------------------
@@ -330,7 +418,8 @@ create table cpf_subject_internal (
     subject_id          int,                -- (fk -> vocabulary.id)
                                             primary key(id, version));
 
-create view cpf_subject as select distinct on (id) * from cpf_subject_internal order by id asc, version desc; 
+select current_table('cpf_subject');
+create index cpf_subject_cpf_idx on cpf_subject (cpf_id);
 
 create table name_contributor_internal (         -- Link names to their contributing organization
 --------------------------------
@@ -341,4 +430,28 @@ create table name_contributor_internal (         -- Link names to their contribu
     name_type           int,                -- (fk -> vocabulary.id) -- type of name (authorizedForm, alternativeForm)
                                             primary key(id, version));
 
-create view name_contributor as select distinct on (id) * from name_contributor_internal order by id asc, version desc; 
+select current_table('name_contributor');
+create index name_contributor_name_idx on name_contributor (name_id);
+
+
+--
+-- D. Import Bookkeeping
+--
+create table import_journal (               -- Progress of each import job, committed along with its data
+--------------------------------
+    job                 text                primary key,   -- name of the job (the importer, by default)
+    position            int,                -- number of inputs committed
+    last_input          text,               -- filename (or ark) of the last committed input
+    side_offset         bigint,             -- length of the job's side file (sql-first-import.py --relations) at that point
+    updated             timestamp);         -- time of the commit
+
+create table import_source (                -- Each imported EAC-CPF file, for sql-first-import.py --incremental
+--------------------------------
+    ark_id              text                primary key,   -- control/recordId of the file's record
+    content_hash        text,               -- SHA-1 of the file's bytes
+    event_time          text,               -- latest maintenanceEvent/eventDateTime of the record
+    cpf_id              int,                -- (fk -> cpf.id)
+    filename            text,               -- where the record was last imported from
+    updated             timestamp);         -- time of the import
+
+create index import_source_hash_idx on import_source (content_hash);
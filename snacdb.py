@@ -0,0 +1,812 @@
+from __future__ import print_function
+import array
+import atexit
+import binascii
+import collections
+import hashlib
+import io
+import json
+import os
+import re
+import signal
+import sys
+import threading
+import time
+import traceback
+import zlib
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+# Import the input readers
+from inputs import open_input, record_id
+
+# Shared database helpers for the EAC-CPF importers
+
+# Unique keys of the shared tables, as declared by their unique indexes in
+# schema.sql.  Rows of these tables are found or created with one
+# INSERT ... ON CONFLICT DO NOTHING statement, which is also safe when several
+# importers run at once.
+UNIQUE_KEYS = {
+    "cpf": ("ark_id",),
+    "document": ("href",),
+    "source": ("href",),
+    "contributor": ("short_name",),
+    "nationality": ("nationality",),
+    "vocabulary": ("type", "value"),
+}
+
+# The plain (non-unique) indexes declared in schema.sql, as (name, table,
+# CREATE INDEX statement).  Only reads need them, so sql-indexes.py drops them
+# before a bulk load and builds them again afterwards.
+SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema.sql")
+INDEX = re.compile(r"^create index (\w+) on (\w+)\s*\(([^)]*)\);", re.I | re.M)
+
+def plain_indexes(schema=SCHEMA):
+    with open(schema) as f:
+        return [(m.group(1), m.group(2), "CREATE INDEX IF NOT EXISTS %s ON %s (%s)" % (m.group(1), m.group(2), m.group(3)))
+                for m in INDEX.finditer(f.read())]
+
+# The columns that refer to the shared rows (those with a unique key, other
+# than cpf), as {table: {column: shared table}}, from the "(fk -> table.id)"
+# notes of schema.sql.  A versioned table's references are listed under both
+# its names.  sql-merge.py renumbers them when it merges shards.
+CREATE_TABLE = re.compile(r"^create table (\w+)", re.I)
+REFERENCE = re.compile(r"^\s+(\w+)\s+int\b.*\(fk -> (\w+)\.id\)")
+
+def shared_references(schema=SCHEMA):
+    references = {}
+    table = None
+    with open(schema) as f:
+        for line in f:
+            m = CREATE_TABLE.match(line)
+            if m is not None:
+                table = m.group(1)
+                continue
+            m = REFERENCE.match(line)
+            if m is not None and table is not None and m.group(2) in UNIQUE_KEYS and m.group(2) != "cpf":
+                references.setdefault(table, {})[m.group(1)] = m.group(2)
+                if table.endswith("_internal"):
+                    references.setdefault(table[:-len("_internal")], {})[m.group(1)] = m.group(2)
+    return references
+
+# Most rows sent in one get_or_create statement
+GET_OR_CREATE_BATCH = 1000
+
+
+# Per-table counters of the database helpers.
+#
+# Every call of insert_db, lookup_db, update_db, get_or_create and
+# lookup_cpf_byark (and every vocabulary lookup, by type, and COPY) adds to
+# the calls, rows, cache hits and wall clock seconds of its helper and table.  The
+# importers also count the time they wait for parsed records and for commits.
+# A helper's time includes that of the helpers it calls (lookup_db falls back
+# on insert_db, for one), so the totals of different helpers overlap.  The
+# counters are shared by all threads.
+class Stats(object):
+
+    def __init__(self):
+        # Reentrant, as a SIGUSR1 dump can interrupt an update in the main thread
+        self.lock = threading.RLock()
+        self.counters = {}
+        self.started = time.time()
+
+    def add(self, name, table, seconds, rows=1, hits=0):
+        with self.lock:
+            counter = self.counters.get((name, table))
+            if counter is None:
+                counter = self.counters[(name, table)] = [0, 0, 0, 0.0]
+            counter[0] += 1
+            counter[1] += rows
+            counter[2] += hits
+            counter[3] += seconds
+
+    # Count one call of the block: with stats.timed("lookup_db", table) as t: ...
+    def timed(self, name, table="-", rows=1):
+        return Timing(self, name, table, rows)
+
+    # Yield the items of iterable, counting the time spent waiting for each
+    def iterate(self, name, iterable, table="-"):
+        iterable = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterable)
+            except StopIteration:
+                return
+            self.add(name, table, time.time() - start)
+            yield item
+
+    # The totals, by helper and table
+    def report(self):
+        with self.lock:
+            counters = dict(self.counters)
+        helpers = {}
+        for (name, table), (calls, rows, hits, seconds) in counters.items():
+            helpers.setdefault(name, {})[table] = {"calls": calls, "rows": rows, "hits": hits, "seconds": round(seconds, 6)}
+        return {"pid": os.getpid(), "elapsed": round(time.time() - self.started, 6), "helpers": helpers}
+
+    # Write the totals to filename, or to standard error without one
+    def dump(self, filename=None):
+        report = json.dumps(self.report(), indent=1, sort_keys=True)
+        if filename is None or filename == "-":
+            print(report, file=sys.stderr)
+            return
+        tmp = filename + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(report + "\n")
+        os.rename(tmp, filename)
+
+    # Dump the totals to filename at exit (if there is one) and on SIGUSR1
+    def install(self, filename=None):
+        if filename is not None:
+            atexit.register(self.dump, filename)
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.dump(filename))
+
+class Timing(object):
+
+    def __init__(self, stats, name, table, rows):
+        self.stats = stats
+        self.name = name
+        self.table = table
+        self.rows = rows
+        self.hits = 0
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.add(self.name, self.table, time.time() - self.start, self.rows, self.hits)
+        return False
+
+# The counters of this process
+stats = Stats()
+
+def lookup_db(db, table, var) :
+    with stats.timed("lookup_db", table) as timing:
+        # Tables with a unique key covered by var are resolved in one round trip
+        key = UNIQUE_KEYS.get(table)
+        if key is not None and all([k in var for k in key]):
+            return get_or_create(db, table, [var], key)[0]
+        # Try to select on the exact string we're inserting.  If exists, then return that ID.
+        keys = []
+        values = []
+        for k in var.keys():
+            keys.append(k)
+            values.append(var[k])
+        selstr = ''.join(["SELECT id FROM ", table, " WHERE ", "=%s AND ".join(keys), "=%s LIMIT 1"])
+        db.execute(selstr, values)
+        tmp = db.fetchone()
+        if tmp is not None:
+            timing.hits = 1
+            return tmp[0]
+        return insert_db(db, table, var);
+
+# Insert into database
+def insert_db(db, table, var) :
+    # Select didn't return any rows, so do the normal insert.
+    with stats.timed("insert_db", table):
+        insstr = ''.join(["INSERT INTO ", table, " (", ",".join(var.keys()), ") values ( %(", ")s,%(".join(var.keys()), ")s ) RETURNING id;"])
+        db.execute(insstr, var)
+        return db.fetchone()[0]
+
+# Find or create rows of a table with a unique key, returning their ids in
+# the order of rows.  Each batch is one statement: new rows are inserted with
+# ON CONFLICT DO NOTHING and the ids of rows that already existed are selected
+# alongside.  A row committed by another importer after the statement took
+# its snapshot is seen by neither half, so any key left unresolved is simply
+# tried again.  When several rows share a key, the first one is inserted.
+def get_or_create(db, table, rows, key=None):
+    if key is None:
+        key = UNIQUE_KEYS[table]
+    with stats.timed("get_or_create", table, len(rows)):
+        first = collections.OrderedDict()
+        for row in rows:
+            k = tuple([row[c] for c in key])
+            if k not in first:
+                first[k] = row
+        ids = {}
+        while len(ids) < len(first):
+            # Rows are grouped by their columns so that left out columns keep their defaults
+            groups = collections.OrderedDict()
+            for k, row in first.items():
+                if k not in ids:
+                    groups.setdefault(tuple(row.keys()), []).append((k, row))
+            for columns, group in groups.items():
+                for start in range(0, len(group), GET_OR_CREATE_BATCH):
+                    batch = group[start:start + GET_OR_CREATE_BATCH]
+                    values = []
+                    for k, row in batch:
+                        values.extend([row[c] for c in columns])
+                    for k, row in batch:
+                        values.extend(k)
+                    row_params = ''.join(["(", ",".join(["%s"] * len(columns)), ")"])
+                    key_params = ''.join(["(", ",".join(["%s"] * len(key)), ")"])
+                    selstr = ''.join(["WITH ins AS (INSERT INTO ", table, " (", ",".join(columns), ") values ",
+                                      ",".join([row_params] * len(batch)),
+                                      " ON CONFLICT (", ",".join(key), ") DO NOTHING RETURNING id, ", ",".join(key), ")",
+                                      " SELECT id, ", ",".join(key), " FROM ins UNION ALL SELECT id, ", ",".join(key),
+                                      " FROM ", table, " WHERE (", ",".join(key), ") IN (", ",".join([key_params] * len(batch)), ")"])
+                    db.execute(selstr, values)
+                    for found in db.fetchall():
+                        k = tuple(found[1:])
+                        if k not in ids:
+                            ids[k] = found[0]
+                    # A NULL key never conflicts or matches, so such rows only come back from the insert
+                    for k, row in batch:
+                        if k not in ids and None in k:
+                            raise ValueError("no id returned for %s row with NULL key %r" % (table, k))
+        return [ids[tuple([row[c] for c in key])] for row in rows]
+
+# Look up a cpf record's id by its ark
+def lookup_cpf_byark(db, ark) :
+    with stats.timed("lookup_cpf_byark", "cpf") as timing:
+        db.execute("SELECT id FROM cpf WHERE ark_id=%s LIMIT 1", [ark])
+        tmp = db.fetchone()
+        if tmp is not None:
+            timing.hits = 1
+            return tmp[0]
+        return None
+
+# In-memory map from ark_id to cpf.id, so rel-import.py can resolve every
+# cpfRelation locally instead of with one SELECT per ark.
+#
+# The map is loaded once through a server-side cursor, in byte order
+# (COLLATE "C").  Each ark is split at its last "/" and the suffixes sharing a
+# prefix are packed into one sorted blob, with array offsets into it and an
+# array of ids, and found by binary search.  SNAC arks all share the prefix
+# http://n2t.net/ark:/99166/ and have 8 byte suffixes, so each ark costs about
+# 16 bytes (8 of suffix, 4 of offset, 4 of id): roughly 160 MB for 10 million
+# arks, where a dict of ark strings to ints would need over 1.5 GB.
+class ArkMap(object):
+
+    def __init__(self):
+        # prefix -> [suffix blob, suffix offsets, ids]
+        self.blocks = {}
+        self.size = 0
+
+    # Read every ark and id of the cpf table
+    def load(self, conn, itersize=100000):
+        cur = conn.cursor(name="ark_map")
+        cur.itersize = itersize
+        cur.execute('SELECT ark_id, id FROM cpf WHERE ark_id IS NOT NULL ORDER BY ark_id COLLATE "C"')
+        for ark, cpfid in cur:
+            prefix, suffix = self._split(ark)
+            block = self.blocks.get(prefix)
+            if block is None:
+                block = self.blocks[prefix] = [bytearray(), array.array('I', [0]), array.array('i')]
+            block[0].extend(suffix)
+            block[1].append(len(block[0]))
+            block[2].append(cpfid)
+            self.size += 1
+        cur.close()
+        for block in self.blocks.values():
+            block[0] = bytes(block[0])
+        return self.size
+
+    def _split(self, ark):
+        if not isinstance(ark, bytes):
+            ark = ark.encode("utf-8")
+        cut = ark.rfind(b"/") + 1
+        return ark[:cut], ark[cut:]
+
+    # The cpf id of ark, or None if there is no such record
+    def get(self, ark):
+        if ark is None:
+            return None
+        prefix, suffix = self._split(ark)
+        block = self.blocks.get(prefix)
+        if block is None:
+            return None
+        blob, offsets, ids = block
+        lo = 0
+        hi = len(ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if blob[offsets[mid]:offsets[mid + 1]] < suffix:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(ids) and blob[offsets[lo]:offsets[lo + 1]] == suffix:
+            return ids[lo]
+        return None
+
+# Update a table in the database
+def update_db(db, table, var, where) :
+    with stats.timed("update_db", table):
+        insstr = ''.join(["UPDATE ", table, " SET (", ",".join(var.keys()), ") = ( %(", ")s,%(".join(var.keys()), ")s ) WHERE ", where, " RETURNING id;"])
+        db.execute(insstr, var)
+        return db.fetchone()[0]
+
+
+# In-process cache of the vocabulary table, keyed by (type, value).
+#
+# The whole table is read once at startup, so almost every vocabulary lookup
+# is answered without a round trip; a miss falls back to lookup_db and the
+# new id is remembered.  Optionally the cache can be saved to a snapshot file
+# at the end of a run and read back on the next one.  A snapshot is only
+# trusted while the table still has the row count and highest id it was
+# taken at; otherwise the cache is reloaded from the database.
+class Vocabulary(object):
+
+    def __init__(self, db):
+        self.db = db
+        self.ids = {}
+        self.hits = 0
+        self.misses = 0
+
+    # Fill the cache, from the snapshot file if it is still current
+    def load(self, snapshot=None):
+        self.db.execute("SELECT count(*), max(id) FROM vocabulary")
+        state = list(self.db.fetchone())
+        if snapshot is not None and os.path.exists(snapshot):
+            with open(snapshot) as f:
+                saved = json.load(f)
+            if saved["state"] == state:
+                self.ids = dict(((t, v), i) for i, t, v in saved["rows"])
+                return len(self.ids)
+            print("Vocabulary snapshot", snapshot, "is out of date, reloading", file=sys.stderr)
+        self.ids = {}
+        self.db.execute("SELECT id, type, value FROM vocabulary")
+        for i, t, v in self.db.fetchall():
+            self.ids[(t, v)] = i
+        return len(self.ids)
+
+    # Write the cache out so the next run can start warm
+    def save(self, snapshot):
+        self.db.execute("SELECT count(*), max(id) FROM vocabulary")
+        state = list(self.db.fetchone())
+        rows = [[i, t, v] for (t, v), i in self.ids.items()]
+        tmp = snapshot + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"state": state, "rows": rows}, f)
+        os.rename(tmp, snapshot)
+
+    # Get the id of a vocabulary term, adding it to the table if needed
+    def lookup(self, type, value):
+        with stats.timed("vocabulary", type) as timing:
+            key = (type, value)
+            vid = self.ids.get(key)
+            if vid is not None:
+                self.hits += 1
+                timing.hits = 1
+                return vid
+            self.misses += 1
+            vid = lookup_db(self.db, "vocabulary", {'type':type, 'value':value})
+            self.ids[key] = vid
+            return vid
+
+
+# Progress journal of an import job, kept in the import_journal table.
+#
+# The importers record how many of their inputs are done, and the name of the
+# last one, in the same transaction as the rows they commit, so the journal
+# never runs ahead of or behind the data.  With --resume a rerun skips the
+# inputs already committed instead of starting over.
+class Journal(object):
+
+    def __init__(self, db, job):
+        self.db = db
+        self.job = job
+        # Position, last input and side file offset at the start of this run
+        self.start = 0
+        self.last = None
+        self.offset = None
+        self.found = False
+
+    # Read back the last committed position of the job
+    def load(self):
+        self.db.execute("SELECT position, last_input, side_offset FROM import_journal WHERE job=%s", [self.job])
+        row = self.db.fetchone()
+        if row is not None:
+            self.start, self.last, self.offset = row
+            self.found = True
+        return self.start
+
+    # Drop the inputs already committed, making sure the last of them is the
+    # one the journal names (otherwise the input is not the same as before)
+    def skip(self, inputs, name=lambda item: item):
+        inputs = iter(inputs)
+        last = None
+        for n in range(self.start):
+            try:
+                last = name(next(inputs))
+            except StopIteration:
+                raise ValueError("input of job %s ends before its journaled position %d" % (self.job, self.start))
+        if last != self.last:
+            raise ValueError("input %d of job %s is %r, but the journal has %r" % (self.start, self.job, last, self.last))
+        return inputs
+
+    # Note that the inputs up to position, the last of them named last, are
+    # done; commit to make it so
+    def record(self, position, last, offset=None):
+        self.db.execute("INSERT INTO import_journal (job, position, last_input, side_offset, updated) VALUES (%s, %s, %s, %s, current_timestamp)"
+                        " ON CONFLICT (job) DO UPDATE SET position=excluded.position, last_input=excluded.last_input,"
+                        " side_offset=excluded.side_offset, updated=excluded.updated",
+                        [self.job, position, last, offset])
+
+
+# Columns of the cpf row that come from the EAC-CPF file, so that a record
+# imported again can be rewritten in place
+CPF_COLUMNS = ("ark_id", "name_id", "entity_type", "gender", "language_code", "script_code",
+               "language_used", "script_used", "biog_hist", "conven_dec_citation",
+               "maintenance_agency", "maintenance_status")
+
+# Tables the importers fill with rows of one cpf record, by cpf_id
+RECORD_TABLES = ("dates", "cpf_sources", "cpf_occupation", "cpf_subject", "cpf_nationality",
+                 "cpf_history", "cpf_otherids", "cpf_document")
+
+# Delete the rows of a cpf record (all but the cpf row itself, and the
+# relations pointing to it from other records), to import it again under the
+# same id
+def delete_record(db, cpfid):
+    db.execute("DELETE FROM name_contributor WHERE name_id IN (SELECT id FROM name WHERE cpf_id=%s)", [cpfid])
+    for table in RECORD_TABLES + ("name",):
+        db.execute(''.join(["DELETE FROM ", table, " WHERE cpf_id=%s"]), [cpfid])
+    db.execute("DELETE FROM cpf_relations WHERE cpf_id1=%s", [cpfid])
+
+
+# SHA-1 of a file's bytes (after decompression, see inputs.py)
+def file_hash(filename, blocksize=1 << 20):
+    digest = hashlib.sha1()
+    f = open_input(filename)
+    try:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            digest.update(block)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+# The EAC-CPF files already imported, kept in the import_source table with
+# their content hash and the latest maintenance event of their record, so an
+# incremental import only parses the files that changed since.
+#
+# Every known hash is read once at startup, in byte order, and the first 8
+# bytes of each are packed into one sorted blob and found by binary search:
+# 8 bytes a file, or 80 MB for 10 million files.  (Two different files agree
+# on 64 bits of SHA-1 with negligible odds.)  The rest of a file's entry is
+# only read, with a query of its own, when the file has changed.
+class ImportSources(object):
+
+    def __init__(self):
+        self.hashes = b""
+        self.size = 0
+        # name -> hash of the entries kept
+        self.pending = {}
+        self.unchanged = 0
+
+    # Read every known content hash
+    def load(self, conn, itersize=100000):
+        hashes = bytearray()
+        cur = conn.cursor(name="import_sources")
+        cur.itersize = itersize
+        cur.execute('SELECT content_hash FROM import_source WHERE content_hash IS NOT NULL ORDER BY content_hash COLLATE "C"')
+        for (content_hash,) in cur:
+            hashes.extend(binascii.unhexlify(content_hash[:16]))
+        cur.close()
+        self.hashes = bytes(hashes)
+        self.size = len(self.hashes) // 8
+        return self.size
+
+    def known(self, content_hash):
+        key = binascii.unhexlify(content_hash[:16])
+        lo = 0
+        hi = self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.hashes[mid * 8:mid * 8 + 8] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo < self.size and self.hashes[lo * 8:lo * 8 + 8] == key
+
+    # Whether the content of an entry (see inputs.py) is not known yet, for
+    # Skips.select(); take() then tells the hash of each entry kept
+    def keep(self, name, data):
+        if data is None:
+            content_hash = file_hash(name)
+        else:
+            content_hash = hashlib.sha1(data).hexdigest()
+        if self.known(content_hash):
+            self.unchanged += 1
+            return False
+        self.pending[name] = content_hash
+        return True
+
+    def take(self, name):
+        return self.pending.pop(name)
+
+    # The cpf id of the record with ark and its latest maintenance event when
+    # last imported, or None if it is not in the database
+    def lookup(self, db, ark):
+        db.execute("SELECT cpf.id, import_source.event_time FROM cpf LEFT JOIN import_source ON import_source.ark_id = cpf.ark_id"
+                   " WHERE cpf.ark_id=%s LIMIT 1", [ark])
+        return db.fetchone()
+
+    # Note that the record with ark was imported from filename; commit to make it so
+    def record(self, db, ark, content_hash, event_time, cpfid, filename):
+        db.execute("INSERT INTO import_source (ark_id, content_hash, event_time, cpf_id, filename, updated) VALUES (%s, %s, %s, %s, %s, current_timestamp)"
+                   " ON CONFLICT (ark_id) DO UPDATE SET content_hash=excluded.content_hash, event_time=excluded.event_time,"
+                   " cpf_id=excluded.cpf_id, filename=excluded.filename, updated=excluded.updated",
+                   [ark, content_hash, event_time, cpfid, filename])
+
+
+# Inputs dropped before they are parsed (as unchanged, or as another shard's)
+# still count towards the journaled position of the inputs after them.
+# select() yields the entries keep(name, data) accepts, and take() tells how
+# many were dropped, by this or an earlier select(), just before each.
+class Skips(object):
+
+    def __init__(self):
+        self.pending = {}
+
+    def select(self, entries, keep):
+        skipped = 0
+        for name, data in entries:
+            skipped += self.pending.pop(name, 0)
+            if not keep(name, data):
+                skipped += 1
+                continue
+            if skipped:
+                self.pending[name] = skipped
+                skipped = 0
+            yield name, data
+
+    def take(self, name):
+        return self.pending.pop(name, 0)
+
+
+# Partition, out of n, that the record with the given ark belongs to.  The
+# hash is CRC-32 rather than hash(), so it is the same in every process.
+# Records without an ark all go to partition 0.
+def ark_partition(ark, n):
+    if ark is None:
+        return 0
+    if not isinstance(ark, bytes):
+        ark = ark.encode("utf-8")
+    return (zlib.crc32(ark) & 0xffffffff) % n
+
+# One of count imports of the same inputs, each into a database of its own,
+# to be merged into one with sql-merge.py (sql-first-import.py --shard).
+#
+# The shard imports the records whose ark_id falls in its partition (records
+# without one go to shard 0).  Those are found before parsing where the
+# recordId can be read off the bytes of the input, and after it otherwise.
+# claim() gives the shard its own ids: every value the sequences hand out in
+# shard index, 0-based, is index + 1 modulo count, so the cpf, name, link and
+# vocabulary ids of the shards never collide and only the shared rows need to
+# be reconciled when they are merged.
+class Shard(object):
+
+    SEQUENCES = ("cpf_id_seq", "unique_id_seq", "vocabulary_id_seq")
+
+    def __init__(self, index, count):
+        self.index = index
+        self.count = count
+
+    def owns(self, ark):
+        return ark_partition(ark, self.count) == self.index
+
+    # Whether an entry (see inputs.py) may be this shard's, for Skips.select()
+    def keep(self, name, data):
+        if data is None:
+            return True
+        ark = record_id(data)
+        return ark is None or self.owns(ark)
+
+    # Move the sequences to this shard's values; commit to make it so
+    def claim(self, db):
+        for sequence in self.SEQUENCES:
+            db.execute("SELECT last_value FROM " + sequence)
+            row = db.fetchone()
+            last = row[0] if row is not None else 0
+            db.execute("ALTER SEQUENCE " + sequence + " INCREMENT BY %s", [self.count])
+            db.execute("SELECT setval(%s, %s, false)", [sequence, last + 1 + (self.index - last) % self.count])
+
+
+# Shared rows of an import that writes through several connections.
+#
+# The vocabulary and the source, document and contributor rows are shared by
+# all records.  Each writer connection keeps its own transaction open for many
+# records, so if they inserted shared rows themselves a connection would wait
+# on rows another had inserted but not committed, and two would soon deadlock.
+# Instead the shared rows are found or created through one connection of their
+# own, in autocommit mode, a statement at a time under a lock: each new row is
+# committed, and visible to every connection, as soon as it exists.  (A writer
+# that then fails leaves at worst an unused shared row behind.)  With a single
+# connection this simply uses it, inside its transactions, as before.
+class SharedRows(object):
+
+    def __init__(self, db):
+        self.db = db
+        self.vocab = Vocabulary(db)
+        self.lock = threading.Lock()
+
+    def lookup(self, type, value):
+        with self.lock:
+            return self.vocab.lookup(type, value)
+
+    def get_or_create(self, table, rows, key=None):
+        with self.lock:
+            return get_or_create(self.db, table, rows, key)
+
+
+# Client-side blocks of sequence values.
+#
+# Instead of inserting with RETURNING id to learn each new row's id, the
+# importer reserves ids from the table's sequence (cpf_id_seq for cpf,
+# unique_id_seq for everything else) a block at a time and assigns them
+# itself, so a whole record can be buffered and written without waiting on
+# the server.  The block is taken with one nextval() per id rather than by
+# moving the sequence with setval(), so concurrent importers stay safe; ids
+# left over at the end of a run are simply never used.
+class IdBlock(object):
+
+    def __init__(self, db, sequence, size=1000):
+        self.db = db
+        self.sequence = sequence
+        self.size = size
+        self.ids = collections.deque()
+
+    def take(self):
+        if not self.ids:
+            self.db.execute("SELECT nextval(%s) FROM generate_series(1, %s)", [self.sequence, self.size])
+            self.ids.extend([row[0] for row in self.db.fetchall()])
+        return self.ids.popleft()
+
+
+# Background database writer.
+#
+# The importers parse records in the main thread and hand each one to put().
+# A writer thread takes them from a bounded queue and applies them to the
+# database, so the next record is parsed while the statements of the last one
+# are in flight.  With a depth of 0 there is no thread and put() applies the
+# record straight away.  The first error raised while applying a record stops
+# the writer (records still queued are dropped) and is raised again from the
+# next put() or from close().
+class RecordWriter(object):
+
+    def __init__(self, apply, depth=0):
+        self.apply = apply
+        self.error = None
+        self.thread = None
+        if depth > 0:
+            self.queue = queue.Queue(depth)
+            self.thread = threading.Thread(target=self._run, name="writer")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is None:
+                try:
+                    self.apply(*item)
+                except Exception as e:
+                    traceback.print_exc()
+                    self.error = e
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def put(self, *item):
+        if self.thread is None:
+            self.apply(*item)
+            return
+        self._check()
+        self.queue.put(item)
+
+    # Wait for every queued record to be applied
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self._check()
+
+
+# Python 2/3 text type, for formatting COPY rows
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+# Format one value as a field of COPY's text format
+def copy_value(value):
+    if value is None:
+        return "\\N"
+    if value is True:
+        return "t"
+    if value is False:
+        return "f"
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    elif not isinstance(value, text_type):
+        value = text_type(value)
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+# Read back one field written by copy_value
+COPY_ESCAPES = {"\\": "\\", "t": "\t", "n": "\n", "r": "\r"}
+def copy_field(field):
+    if field == "\\N":
+        return None
+    return re.sub(r"\\(.)", lambda m: COPY_ESCAPES.get(m.group(1), m.group(1)), field)
+
+
+# Relation side file.  sql-first-import.py --relations writes the cpfRelations
+# of every record it imports, one tab separated line (in COPY's text format)
+# of ark, target ark, arcrole and relationEntry each, so that rel-import.py
+# can link the records without parsing the EAC-CPF files a second time.
+
+def write_relations(f, ark, relations):
+    for rel in relations:
+        f.write(u"\t".join([copy_value(v) for v in (ark, rel["relation_ark_id"], rel["relation_type"], rel["relation_entry"])]) + u"\n")
+
+# Yield (ark, relations) for each record of a relation side file
+def read_relations(f):
+    ark = None
+    relations = []
+    for line in f:
+        fields = [copy_field(field) for field in line.rstrip(u"\n").split(u"\t")]
+        if fields[0] != ark and relations:
+            yield ark, relations
+            relations = []
+        ark = fields[0]
+        relations.append({'relation_ark_id':fields[1], 'relation_type':fields[2], 'relation_entry':fields[3]})
+    if relations:
+        yield ark, relations
+
+
+# Row writers.  Rows whose id the importer never needs back (the link and
+# detail tables) are handed to a writer instead of insert_db.  RowWriter
+# inserts each one straight away; CopyWriter buffers them and loads them in
+# large batches with COPY ... FROM STDIN.  Either way flush() must be called
+# before committing.
+
+class RowWriter(object):
+
+    def __init__(self, db):
+        self.db = db
+
+    def insert(self, table, var):
+        insert_db(self.db, table, var)
+
+    def flush(self):
+        pass
+
+
+class CopyWriter(object):
+
+    def __init__(self, db, batch=10000):
+        self.db = db
+        self.batch = batch
+        # Rows are grouped by table and column list, so that every column a
+        # row leaves out still gets its default, just as with INSERT
+        self.buffers = {}
+        self.buffered = 0
+
+    def insert(self, table, var):
+        columns = tuple(sorted(var.keys()))
+        key = (table, columns)
+        lines = self.buffers.get(key)
+        if lines is None:
+            lines = self.buffers[key] = []
+        lines.append(u"\t".join([copy_value(var[c]) for c in columns]))
+        self.buffered += 1
+        if self.buffered >= self.batch:
+            self.flush()
+
+    def flush(self):
+        for (table, columns), lines in self.buffers.items():
+            with stats.timed("copy", table, len(lines)):
+                data = io.BytesIO((u"\n".join(lines) + u"\n").encode("utf-8"))
+                self.db.copy_expert(''.join(["COPY ", table, " (", ",".join(columns), ") FROM STDIN"]), data)
+        self.buffers = {}
+        self.buffered = 0
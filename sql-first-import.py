@@ -1,303 +1,171 @@
 from __future__ import print_function
+import argparse
 import codecs
+import io
 import os
-import fileinput
 import sys
-# Import XML parser
-import xml.etree.ElementTree as ET
-# Import Postgres connector
-import psycopg2 as pgsql
+# Import the shared EAC-CPF parser
+import eaccpf
+# Import the input readers
+import inputs
+# Import the database backends
+import dbbackend
+# Import the shared database helpers
+from snacdb import insert_db, update_db, SharedRows, RowWriter, CopyWriter, IdBlock, Journal, RecordWriter, ark_partition, write_relations, stats, ImportSources, CPF_COLUMNS, delete_record, Skips, Shard
 
-# Portability
-try:
-    register_namespace = ET.register_namespace
-except AttributeError:
-    def register_namespace(prefix, uri):
-        ET._namespace_map[uri] = prefix
+# Shard I/N of --shard, 0-based
+def shard_spec(value):
+    try:
+        index, count = [int(n) for n in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected I/N, such as 0/4")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError("shard %d/%d is not one of 0/%d to %d/%d" % (index, count, count, count - 1, count))
+    return Shard(index, count)
 
-# Error printing
-def warning(*objs):
-    print("WARN: ", *objs, file=sys.stderr)
+# Command line options
+parser = argparse.ArgumentParser(description="First pass: import EAC-CPF records and their documents into Postgres")
+parser.add_argument("--vocabulary-snapshot", metavar="FILE", help="warm start the vocabulary cache from FILE, and save it there at the end of the run")
+parser.add_argument("--copy", action="store_true", help="buffer the link and detail rows and load them with COPY instead of one INSERT each")
+parser.add_argument("--copy-batch", type=int, default=10000, metavar="N", help="rows to buffer before each COPY (default: %(default)s)")
+parser.add_argument("--client-ids", action="store_true", help="reserve name ids from their sequence in blocks, as is always done for cpf ids, instead of inserting with RETURNING id, so they can be buffered (and COPYed) too")
+parser.add_argument("--id-block", type=int, default=1000, metavar="N", help="ids to reserve from a sequence at a time (default: %(default)s)")
+parser.add_argument("--write-queue", type=int, default=0, metavar="N", help="apply records to the database in a background thread, with up to N parsed records queued for it (default: %(default)s, no thread)")
+parser.add_argument("--connections", type=int, default=1, metavar="N", help="write through N database connections, each with its own writer thread, routing every record by a hash of its ark_id (default: %(default)s)")
+parser.add_argument("--relations", metavar="FILE", help="also write the cpfRelations of every record to FILE (FILE.0, FILE.1, ... with --connections), for rel-import.py --relations")
+parser.add_argument("--job", default="sql-first-import", help="name of this import in the progress journal (default: %(default)s)")
+parser.add_argument("--commit-every", type=int, default=100000, metavar="N", help="records to import per transaction, and so at most to redo after a crash (default: %(default)s)")
+parser.add_argument("--resume", action="store_true", help="skip the input files the job has already committed, and carry on from there")
+parser.add_argument("--incremental", action="store_true", help="only parse the files whose content changed since they were last imported with --incremental, and import their records again in place")
+parser.add_argument("--shard", type=shard_spec, metavar="I/N", help="import only the records whose ark_id hashes to shard I (0-based) of N, with ids no other shard uses, into this shard's own database, for sql-merge.py to merge")
+parser.add_argument("--stats", metavar="FILE", help="write per-table counts and timings of the database calls to FILE as JSON at exit, and whenever the process gets SIGUSR1 (which writes them to standard error without --stats)")
+inputs.add_arguments(parser)
+eaccpf.add_arguments(parser)
+dbbackend.add_arguments(parser)
+args = parser.parse_args()
+stats.install(args.stats)
+eaccpf.report.install(args)
 
-# Get the name of a tag
-def valueOf(tag):
-    return tag.split("}")[1][0:]
-
-# Get the value of a term
-def termOnly(term):
-    return term.split("#")[1][0:]
+# Connect to the database
+def connect():
+    return dbbackend.connect(args)
+db = connect()
+db_cur = db.cursor()
 
-def lookup_db(db, table, var) :
-    # Try to select on the exact string we're inserting.  If exists, then return that ID.
-    keys = []
-    values = []
-    for k in var.keys():
-        keys.append(k)
-        values.append(var[k])
-    selstr = ''.join(["SELECT id FROM ", table, " WHERE ", "=%s AND ".join(keys), "=%s LIMIT 1"])
-    db.execute(selstr, values)
-    tmp = db.fetchone()
-    if tmp is not None:
-        return tmp[0]
-    return insert_db(db, table, var);
+# A shard takes its own ids from the sequences
+if args.shard is not None:
+    args.shard.claim(db_cur)
+    db.commit()
 
-# Insert into database
-def insert_db(db, table, var) :
-    # Select didn't return any rows, so do the normal insert.
-    insstr = ''.join(["INSERT INTO ", table, " (", ",".join(var.keys()), ") values ( %(", ")s,%(".join(var.keys()), ")s ) RETURNING id;"])
-    db.execute(insstr, var)
-    return db.fetchone()[0]
-    
-# Update a table in the database
-def update_db(db, table, var, where) :
-    insstr = ''.join(["UPDATE ", table, " SET (", ",".join(var.keys()), ") = ( %(", ")s,%(".join(var.keys()), ")s ) WHERE ", where, " RETURNING id;"])
-    db.execute(insstr, var)
-    return db.fetchone()[0]
+# The content hash of every file imported before, to skip the unchanged ones
+if args.incremental:
+    imported = ImportSources()
+    print("Loaded", imported.load(db), "imported file hashes", file=sys.stderr)
+    db.commit()
 
+# The vocabulary, source, document and contributor rows shared by all records.
+# With several connections, the first one is kept for them alone.
+if args.connections > 1:
+    db.autocommit = True
+shared = SharedRows(db_cur)
+vocab = shared.vocab
 
-# Define the namespaces to use
-namespaces = { "snac" : "urn:isbn:1-931666-33-4" ,
-        "snac2" : "http://socialarchive.iath.virginia.edu/control/term#",
-        "schema" : "http://schema.org/",
-        "xlink" : "http://www.w3.org/1999/xlink",
-        "snac3" : "http://socialarchive.iath.virginia.edu/"}
-# Register the namespaces
-ET.register_namespace("eac-cpf", "urn:isbn:1-931666-33-4")
-ET.register_namespace("snac2", "http://socialarchive.iath.virginia.edu/control/term#")
-ET.register_namespace("snac", "http://socialarchive.iath.virginia.edu/")
-ET.register_namespace("xlink", "http://www.w3.org/1999/xlink")
+# Preload the vocabulary cache
+print("Loaded", vocab.load(args.vocabulary_snapshot), "vocabulary terms", file=sys.stderr)
 
-languages = {}
-scripts = {}
-
-# Connect to the postgres DB
-db = pgsql.connect("host=localhost dbname=eaccpf user=snac password=snacsnac")
-db_cur = db.cursor()
+# A connection that records are written through, with the writer for the
+# rows whose ids we never need back, the blocks of ids reserved for the rows
+# we need ids back from, the progress journal (to resume from the last commit
+# after a crash) and the side file of the records' relations for the second
+# pass.  Each one commits on its own, every --commit-every of its records.
+class Partition(object):
 
-# Counter
-i = 0
+    def __init__(self, db, job, relations):
+        self.db = db
+        self.cur = db.cursor()
+        if args.copy:
+            self.writer = CopyWriter(self.cur, args.copy_batch)
+        else:
+            self.writer = RowWriter(self.cur)
+        self.cpf_ids = IdBlock(self.cur, "cpf_id_seq", args.id_block)
+        if args.client_ids:
+            self.unique_ids = IdBlock(self.cur, "unique_id_seq", args.id_block)
+        self.journal = Journal(self.cur, job)
+        self.relations = relations
+        # Records imported by this run, and input position and name of the last one
+        self.count = 0
+        self.position = 0
+        self.last = None
 
-# For each file given on standard input, parse and look at
-for filename in fileinput.input():
+    # Read back the journal, and cut the side file back to its length at the
+    # last commit
+    def resume(self):
+        self.journal.load()
+        if not self.journal.found:
+            parser.error("there is no job %s to resume" % self.journal.job)
+        self.position = self.journal.start
+        self.last = self.journal.last
+        if self.relations is not None:
+            if self.journal.start > 0:
+                if self.journal.offset is None:
+                    parser.error("job %s was not writing a --relations file" % self.journal.job)
+                self.relationsf = io.open(self.relations, "r+", encoding="utf-8")
+                self.relationsf.seek(self.journal.offset)
+                self.relationsf.truncate()
+            else:
+                self.relationsf = io.open(self.relations, "w", encoding="utf-8")
 
-    print("Parsing: ", filename.strip(), file=sys.stderr)
-    tree = ET.parse(filename.strip())
-    root = tree.getroot()
+    def start(self):
+        self.journal.record(0, None)
+        with stats.timed("commit"):
+            self.db.commit()
+        if self.relations is not None:
+            self.relationsf = io.open(self.relations, "w", encoding="utf-8")
 
-    # Tables in SQL
-    cpf = {}
-    names = []
-    dates = []
-    sources = []
-    documents = []
-    occupations = []
-    places = []
-    subjects = []
-    nationalities = []
-    biogHists = []
-    cpf_otherids = []
-    cpf_history = []
-    cpf_relations = []
+    # Flush the buffered rows and commit them together with the journal
+    def commit(self):
+        self.writer.flush()
+        offset = None
+        if self.relations is not None:
+            self.relationsf.flush()
+            os.fsync(self.relationsf.fileno())
+            offset = self.relationsf.tell()
+        self.journal.record(self.position, self.last, offset)
+        with stats.timed("commit"):
+            self.db.commit()
 
-    # Parse each known tag, in order.  Any missing, report to the warning function.  
-    # That way, we can keep track of all problematic or missing tags from the schema
-    for node in root:
-        tag = valueOf(node.tag)
-        
-        if (tag == "control"):
-            # Handle control elements
-            for control in node:
-                ctag = valueOf(control.tag)
-            
-                if (ctag == "recordId"):
-                    cpf["ark_id"] = control.text
-                elif (ctag == "otherRecordId"):
-                    cpf_otherids.append({'link_type': termOnly(control.get('localType')), 'other_id': control.text})
-                elif (ctag == "maintenanceStatus"):
-                    cpf["maintenance_status"] = control.text
-                elif (ctag == "maintenanceAgency"):
-                    cpf["maintenance_agency"] = control[0].text
-                elif (ctag == "languageDeclaration"):
-                    cpf["language_code"] = control[0].get('languageCode')
-                    languages[control[0].get('languageCode')] = control[0].text
-                    cpf["script_code"] = control[1].get('scriptCode')
-                    scripts[control[1].get('scriptCode')] = control[1].text
-                elif (ctag == "conventionDeclaration"):
-                    cpf["conven_dec_citation"] = control[0].text
-                elif (ctag == "maintenanceHistory"):
-                    for maint_event in control:
-                        # handle each event individually
-                        maint_history = {}
-                        if (valueOf(maint_event.tag) == 'maintenanceEvent'):
-                            #handle
-                            for maint_part in maint_event:
-                                if (valueOf(maint_part.tag) == 'eventType'):
-                                    maint_history["event_type"] = maint_part.text
-                                elif (valueOf(maint_part.tag) == 'eventDateTime'):
-                                    maint_history["modified_time"] = maint_part.text
-                                elif (valueOf(maint_part.tag) == 'agentType'):
-                                    maint_history["agent_type"] = maint_part.text
-                                elif (valueOf(maint_part.tag) == 'agent'):
-                                    maint_history["agent"] = maint_part.text
-                                elif (valueOf(maint_part.tag) == 'eventDescription'):
-                                    maint_history["description"] = maint_part.text
-                                else:
-                                    warning("Unknown Tag: ", tag, ctag, valueOf(maint_event.tag), valueOf(maint_part.tag))
-                        else:
-                            warning("Unknown Tag: ", tag, ctag, valueOf(maint_event.tag))
-                        cpf_history.append(maint_history)
-                elif (ctag == "sources"):
-                    for source in control:
-                        sources.append({'source_type': source.get('{http://www.w3.org/1999/xlink}type'), 'href': source.get('{http://www.w3.org/1999/xlink}href')});
-                        # TODO: what about the full text of the source?
-                else:
-                    warning("Unknown Tag: ", tag, ctag)
+    def close(self):
+        if self.relations is not None:
+            self.relationsf.close()
+        self.cur.close()
+        self.db.close()
 
-        elif (tag == "cpfDescription"):
-            # Handle cpfDescription
-            for desc in node:
-                dtag = valueOf(desc.tag)
-                
-                if (dtag == "identity"):
-                    for ident in desc:
-                        itag = valueOf(ident.tag)
-                        if (itag == "entityType"):
-                            cpf["entity_type"] = ident.text
-                        elif(itag == "nameEntry"):
-                            # convention: first name in the name table is the preferred name
-                            # language, preference_score, authorized_form,original, corporate_name, 
-                            # contributor[{contributor, name_type}]
-                            name = {}
-                            name_contrib = []
-                            name["preference_score"] = ident.get("{http://socialarchive.iath.virginia.edu/}preferenceScore")
-                            for name_part in ident:
-                                if (valueOf(name_part.tag) == "part"):
-                                    name["original"] = name_part.text
-                                elif (valueOf(name_part.tag) == "alternativeForm" or
-                                      valueOf(name_part.tag) == "authorizedForm"):
-                                    name_contrib.append({"contributor":name_part.text, "name_type":valueOf(name_part.tag)})
-                                else:
-                                    warning("Unknown Tag: ", tag, dtag, itag, valueOf(name_part.tag))
-                            name["contributor"] = name_contrib
-                            names.append(name)
-                        else:
-                            warning("Unknown Tag: ", tag, dtag, itag, valueOf(name_part.tag))
-                elif (dtag == "description"):
-                    for description in desc:
-                        d2tag = valueOf(description.tag)
-                        if (d2tag == "existDates"):
-                            for edates in description:
-                                if (valueOf(edates.tag) == "dateRange"):
-                                    date = {}
-                                    date["is_range"] = True
-                                    if (valueOf(edates[0].tag) == "fromDate"):
-                                        if (edates[0].text is not None):
-                                            stddate = edates[0].get("standardDate")
-                                            if stddate[:1] == "-":
-                                                date["from_bc"] = True
-                                                stddate = stddate[1:]
-                                            date["from_date"] = stddate 
-                                            date["from_original"] = edates[0].text
-                                            date["from_type"] = termOnly(edates[0].get("localType"))
-                                        if (len(edates) > 1 and valueOf(edates[1].tag) == "toDate" and edates[1].text is not None):
-                                            stddate = edates[1].get("standardDate")
-                                            if stddate[:1] == "-":
-                                                date["to_bc"] = True
-                                                stddate = stddate[1:]
-                                            date["to_date"] = stddate 
-                                            date["to_original"] = edates[1].text
-                                            date["to_type"] = termOnly(edates[1].get("localType"))
-                                    elif (valueOf(edates[0].tag) == "toDate"):
-                                        if (edates[0].text is not None):
-                                            stddate = edates[0].get("standardDate")
-                                            if stddate[:1] == "-":
-                                                date["to_bc"] = True
-                                                stddate = stddate[1:]
-                                            date["to_date"] = stddate 
-                                            date["to_original"] = edates[0].text
-                                            date["to_type"] = termOnly(edates[0].get("localType"))
-                                    else:
-                                        warning("Unknown Tag: ", tag, dtag, d2tag, valueOf(edates.tag), valueOf(edates[0].tag))
-                                    dates.append(date)
-                                elif (valueOf(edates.tag) == "date"):
-                                    date = {}
-                                    date["is_range"] = False
-                                    date["from_date"] = edates.get("standardDate")
-                                    date["from_original"] = edates.text
-                                    date["from_type"] = termOnly(edates.get("localType"))
-                                    dates.append(date)
-                                else:
-                                    warning("Unknown Tag: ", tag, dtag, d2tag, valueOf(edates.tag))
-                        elif (d2tag == "place"):
-                            #TODO Handle place tags and snac:placeEntry items
-                            None
-                        elif (d2tag == "localDescription"):
-                            if (termOnly(description.get("localType")) == "AssociatedSubject"):
-                                subjects.append(description[0].text)
-                                if (len(description) > 1):
-                                    warning("Unknown Tag: ", tag, dtag, d2tag, description[1].tag)
-                            elif (termOnly(description.get("localType")) == "nationalityOfEntity"):
-                                nationalities.append(description[0].text)
-                                if (len(description) > 1):
-                                    warning("Unknown Tag: ", tag, dtag, d2tag, description[1].tag)
-                            elif (termOnly(description.get("localType")) == "gender"):
-                                cpf["gender"] = description[0].text
-                                if (len(description) > 1):
-                                    warning("Unknown Tag: ", tag, dtag, d2tag, description[1].tag)
-                            else:
-                                warning("Unknown Attribute: ", tag, dtag, d2tag, "localType = ", description.get("localType"))
-                        elif (d2tag == "languageUsed"):
-                            for lang in description:
-                                if (valueOf(lang.tag) == "language"):
-                                    cpf["language_used"] = lang.get("languageCode")
-                                elif (valueOf(lang.tag) == "script"):
-                                    cpf["script_used"] = lang.get("scriptCode")
-                                else:
-                                    warning("Unknown Tag: ", tag, dtag, d2tag, lang.tag)
-                        elif (d2tag == "occupation"):
-                            occupations.append(description[0].text)
-                            if (len(description) > 1):
-                                warning("Unknown Tag: ", tag, dtag, d2tag, description[1].tag)
-                        elif (d2tag == "biogHist"):
-                            biogHists.append(ET.tostring(description, encoding="UTF-8"))
-                elif (dtag == "relations"):
-                    for rel in desc:
-                        rtag = valueOf(rel.tag)
-                        if (rtag == "cpfRelation"):
-                            relation = {}
-                            if (len(rel) > 1):
-                                warning("Unknown Tag: ", tag, dtag, d2tag, description[1].tag)
-                            relation["relation_type"] = termOnly(rel.get("{http://www.w3.org/1999/xlink}arcrole"))
-                            relation["relation_ark_id"] = rel.get("{http://www.w3.org/1999/xlink}href")
-                            relation["relation_other_type"] = termOnly(rel.get("{http://www.w3.org/1999/xlink}role"))
-                            if (len(rel) > 0):
-                                relation["relation_entry"] = rel[0].text
-                            else:
-                                relation["relation_entry"] = "" 
-                            cpf_relations.append(relation)
-                        elif (rtag == "resourceRelation"):
-                            relation = {}
-                            relation["document_role"] = termOnly(rel.get("{http://www.w3.org/1999/xlink}arcrole"))
-                            relation["href"] = rel.get("{http://www.w3.org/1999/xlink}href")
-                            relation["document_type"] = termOnly(rel.get("{http://www.w3.org/1999/xlink}role"))
-                            relation["link_type"] = rel.get("{http://www.w3.org/1999/xlink}type")
-                            for relitem in rel:
-                                if (valueOf(relitem.tag) == "relationEntry"):
-                                    relation["name"] = relitem.text
-                                elif (valueOf(relitem.tag) == "objectXMLWrap"):
-                                    relation["xml_source"] = ET.tostring(relitem, encoding="UTF-8")
-                                elif (valueOf(relitem.tag) == "descriptiveNote"):
-                                    relation["notes"] = ET.tostring(relitem, encoding="UTF-8")
-                                else:
-                                    warning("Unknown Tag: ", tag, dtag, rtag, relitem.tag)
-                            documents.append(relation)
-                        else:
-                            warning("Unknown Tag: ", tag, dtag, rtag)
-                else:
-                    warning("Unknown Tag: ", tag, dtag)
+if args.connections == 1:
+    partitions = [Partition(db, args.job, args.relations)]
+else:
+    partitions = []
+    for k in range(args.connections):
+        relations = None
+        if args.relations is not None:
+            relations = "%s.%d" % (args.relations, k)
+        partitions.append(Partition(connect(), "%s.%d-of-%d" % (args.job, k, args.connections), relations))
 
-        else:
-            warning("Unknown Tag: ", tag)
+# Import one parsed record into the database
+def import_record(part, position, filename, record, content_hash=None):
+    # The record has been parsed into the rows for each table in SQL
+    cpf = record.cpf
+    names = record.names
+    dates = record.dates
+    sources = record.sources
+    documents = record.documents
+    occupations = record.occupations
+    places = record.places
+    subjects = record.subjects
+    nationalities = record.nationalities
+    biogHist = record.biogHist
+    cpf_otherids = record.cpf_otherids
+    cpf_history = record.cpf_history
+    cpf_relations = record.cpf_relations
 
     # DB interactions:
     # db_cur.execute("SQL STATEMENT %(name)s", {name:"blah",...})
@@ -311,111 +179,206 @@ for filename in fileinput.input():
 
 
     # Create CPF record in database and get ID, returns id   
+
+    # A record imported before is imported again in place, under the same id,
+    # unless the file is older than the one it was imported from
+    known = None
+    if args.incremental:
+        event_time = eaccpf.latest_event(record)
+        known = imported.lookup(part.cur, cpf["ark_id"])
+        if known is not None and known[1] is not None and event_time is not None and event_time < known[1]:
+            print("Skipping", filename, "as its record", cpf["ark_id"], "is older than the one imported", file=sys.stderr)
+            part.position = position
+            part.last = filename
+            return
+        if known is not None:
+            delete_record(part.cur, known[0])
     
     # Lookup the types that need to be changed
 
     if "entity_type" in cpf:
-        cpf["entity_type"] = lookup_db(db_cur, "vocabulary", {'type':'entity_type','value':cpf["entity_type"]})
+        cpf["entity_type"] = shared.lookup('entity_type', cpf["entity_type"])
     if "gender" in cpf:
-        cpf["gender"] = lookup_db(db_cur, "vocabulary", {'type':'gender','value':cpf["gender"]})
+        cpf["gender"] = shared.lookup('gender', cpf["gender"])
     if "language_code" in cpf:
-        cpf["language_code"] = lookup_db(db_cur, "vocabulary", {'type':'language_code','value':cpf["language_code"]})
+        cpf["language_code"] = shared.lookup('language_code', cpf["language_code"])
     if "script_code" in cpf:
-        cpf["script_code"] = lookup_db(db_cur, "vocabulary", {'type':'script_code','value':cpf["script_code"]})
+        cpf["script_code"] = shared.lookup('script_code', cpf["script_code"])
     if "language_used" in cpf:
-        cpf["language_used"] = lookup_db(db_cur, "vocabulary", {'type':'language_code','value':cpf["language_used"]})
+        cpf["language_used"] = shared.lookup('language_code', cpf["language_used"])
     if "script_used" in cpf:
-        cpf["script_used"] = lookup_db(db_cur, "vocabulary", {'type':'script_code','value':cpf["script_used"]})
+        cpf["script_used"] = shared.lookup('script_code', cpf["script_used"])
     if "maintenance_status" in cpf:
-        cpf["maintenance_status"] = lookup_db(db_cur, "vocabulary", {'type':'script_code','value':cpf["maintenance_status"]})
-    cpfid = insert_db(db_cur, "cpf", cpf)
-    print("    This record given PostgreSQL CPF_ID: ", cpfid)
+        cpf["maintenance_status"] = shared.lookup('script_code', cpf["maintenance_status"])
+    # The cpf row is written last, once its name_id and biog_hist are known,
+    # so its id is reserved up front
+    if known is not None:
+        # Columns the file no longer fills are cleared
+        cpfid = known[0]
+        for column in CPF_COLUMNS:
+            cpf.setdefault(column, None)
+    else:
+        cpfid = cpf["id"] = part.cpf_ids.take()
+    if args.verbose:
+        print("    This record given PostgreSQL CPF_ID: ", cpfid)
     #cpfid = 0 # temporary
     for date_entry in dates:
         date_entry["cpf_id"] = cpfid
         if "to_type" in date_entry:
-            date_entry["to_type"] = lookup_db(db_cur, "vocabulary", {'type':'date_type','value':date_entry["to_type"]})
+            date_entry["to_type"] = shared.lookup('date_type', date_entry["to_type"])
         if "from_type" in date_entry:
-            date_entry["from_type"] = lookup_db(db_cur, "vocabulary", {'type':'date_type','value':date_entry["from_type"]})
-        insert_db(db_cur, "dates", date_entry)
-    for source in sources:
+            date_entry["from_type"] = shared.lookup('date_type', date_entry["from_type"])
+        part.writer.insert("dates", date_entry)
+    # The shared source, document and contributor rows of the record are each
+    # found or created in one batch
+    source_ids = shared.get_or_create("source", [{'href':source["href"]} for source in sources])
+    for source, s_id in zip(sources, source_ids):
         if "source_type" in source:
-            source["source_type"] = lookup_db(db_cur, "vocabulary", {'type':'source_type','value':source["source_type"]})
-        s_id = lookup_db(db_cur, "source", {'href':source["href"]})
-        if s_id is None:
-            s_id = insert_db(db_cur, "source", source)
-        insert_db(db_cur, "cpf_sources", {'cpf_id':cpfid, 'source_id':s_id})
+            source["source_type"] = shared.lookup('source_type', source["source_type"])
+        part.writer.insert("cpf_sources", {'cpf_id':cpfid, 'source_id':s_id})
     for occupation in occupations:
         if occupation is not None:   
-            o_id = lookup_db(db_cur, "vocabulary", {'type': 'occupation', 'value':occupation})
-            insert_db(db_cur, "cpf_occupation", {'cpf_id':cpfid, 'occupation_id':o_id})
+            o_id = shared.lookup('occupation', occupation)
+            part.writer.insert("cpf_occupation", {'cpf_id':cpfid, 'occupation_id':o_id})
     for subject in subjects:
         if subject is not None:   
-            s_id = lookup_db(db_cur, "vocabulary", {'type':'subject', 'value':subject})
-            insert_db(db_cur, "cpf_subject", {'cpf_id':cpfid, 'subject_id':s_id})
+            s_id = shared.lookup('subject', subject)
+            part.writer.insert("cpf_subject", {'cpf_id':cpfid, 'subject_id':s_id})
     for nationality in nationalities:
         if nationality is not None:   
-            n_id = lookup_db(db_cur, "vocabulary", {'type':'nationality', 'value':nationality})
-            insert_db(db_cur, "cpf_nationality", {'cpf_id':cpfid, 'nationality_id':n_id})
+            n_id = shared.lookup('nationality', nationality)
+            part.writer.insert("cpf_nationality", {'cpf_id':cpfid, 'nationality_id':n_id})
     for history in cpf_history:
         history["cpf_id"] = cpfid
         if "event_type" in history:
-            history["event_type"] = lookup_db(db_cur, "vocabulary", {'type':'event_type','value':history["event_type"]})
+            history["event_type"] = shared.lookup('event_type', history["event_type"])
         if "agent_type" in history:
-            history["agent_type"] = lookup_db(db_cur, "vocabulary", {'type':'agent_type','value':history["agent_type"]})
-        insert_db(db_cur, "cpf_history", history)
+            history["agent_type"] = shared.lookup('agent_type', history["agent_type"])
+        part.writer.insert("cpf_history", history)
     for otherid in cpf_otherids:
         otherid["cpf_id"] = cpfid
         if "link_type" in otherid:
-            otherid["link_type"] = lookup_db(db_cur, "vocabulary", {'type':'record_type','value':otherid["link_type"]})
-        insert_db(db_cur, "cpf_otherids", otherid)
-    for document in documents:
+            otherid["link_type"] = shared.lookup('record_type', otherid["link_type"])
+        part.writer.insert("cpf_otherids", otherid)
+    document_ids = shared.get_or_create("document", [{'href':document["href"]} for document in documents])
+    for document, d_id in zip(documents, document_ids):
         if "document_type" in document:
-            document["document_type"] = lookup_db(db_cur, "vocabulary", {'type':'document_type','value':document["document_type"]})
+            document["document_type"] = shared.lookup('document_type', document["document_type"])
         if "document_role" in document:
-            document["document_role"] = lookup_db(db_cur, "vocabulary", {'type':'document_role','value':document["document_role"]})
+            document["document_role"] = shared.lookup('document_role', document["document_role"])
         doc_insert =  {'name':document["name"],'href':document["href"],'document_type':document["document_type"]}
-        if document.has_key('xml_source'):
+        if 'xml_source' in document:
             doc_insert['xml_source'] = document["xml_source"]
-        d_id = lookup_db(db_cur, "document", {'href':document["href"]})
-        insert_db(db_cur, "cpf_document", {'cpf_id':cpfid,'document_id':d_id,'document_role':document["document_role"],'link_type':document["link_type"]})
+        part.writer.insert("cpf_document", {'cpf_id':cpfid,'document_id':d_id,'document_role':document["document_role"],'link_type':document["link_type"]})
         
+    contributor_ids = iter(shared.get_or_create("contributor", [{'short_name': contributor["contributor"]} for name in names for contributor in name["contributor"]]))
     first_name = True
     for name in names:
-        n_id = insert_db(db_cur, "name", {'cpf_id':cpfid, 'original': name["original"], 'preference_score':name["preference_score"]})
+        name_row = {'cpf_id':cpfid, 'original': name["original"], 'preference_score':name["preference_score"]}
+        if args.client_ids:
+            n_id = name_row["id"] = part.unique_ids.take()
+            part.writer.insert("name", name_row)
+        else:
+            n_id = insert_db(part.cur, "name", name_row)
         for contributor in name["contributor"]:
-            c_id = lookup_db(db_cur, "contributor", {'short_name': contributor["contributor"]})
+            c_id = next(contributor_ids)
             if "name_type" in contributor:
-                contributor["name_type"] = lookup_db(db_cur, "vocabulary", {'type':'name_type','value':contributor["name_type"]})
-            insert_db(db_cur, "name_contributor", {'name_id':n_id, 'contributor_id':c_id, 'name_type': contributor["name_type"]})
+                contributor["name_type"] = shared.lookup('name_type', contributor["name_type"])
+            part.writer.insert("name_contributor", {'name_id':n_id, 'contributor_id':c_id, 'name_type': contributor["name_type"]})
         if first_name:
-            # update the cpf table to have this name id
-            update_db(db_cur, "cpf", {'name_id':n_id}, "".join(['id=',str(cpfid)]))
+            # the cpf row gets this name id
+            cpf["name_id"] = n_id
             first_name = False
     
-    # Handle merging biog hists to one cell   
-    first_bh = True
-    bh = None
-    for biogHist in biogHists:
-        if first_bh:
-            bh = ET.fromstring(biogHist)
-            first_bh = False
-        else:
-            bh.extend(ET.fromstring(biogHist))
-   
-    if bh is not None:
-        update_db(db_cur, "cpf", {'biog_hist': ET.tostring(bh)},  "".join(['id=',str(cpfid)]))
-    
-    # Commit the changes every 1000
-    i = i + 1
-    if i % 100000 == 0:
-        db.commit()
-        print("** Completed 100000 inserts **")
+    # The biog hists were merged into one cell by the parser
+    if biogHist is not None:
+        cpf["biog_hist"] = biogHist
+    if known is not None:
+        update_db(part.cur, "cpf", cpf, "".join(['id=',str(cpfid)]))
+    else:
+        # Into cpf_internal itself, as COPY cannot write through the cpf view
+        part.writer.insert("cpf_internal", cpf)
+    if part.relations is not None:
+        write_relations(part.relationsf, cpf.get("ark_id"), cpf_relations)
+    if args.incremental:
+        imported.record(part.cur, cpf["ark_id"], content_hash, event_time, cpfid, filename)
     
-db.commit()
+    # Commit the changes every N records
+    part.count = part.count + 1
+    part.position = position
+    part.last = filename
+    if part.count % args.commit_every == 0:
+        part.commit()
+        print("** Completed", args.commit_every, "inserts **")
+
+# Each connection has its own writer thread when there are several
+depth = args.write_queue
+if args.connections > 1 and depth == 0:
+    depth = 8
+for part in partitions:
+    part.importer = RecordWriter(import_record, depth)
+
+# Journal the start of the job, or skip the inputs it has already committed.
+# Inputs are skipped unparsed up to the position of the partition that is
+# furthest behind; after that, each partition drops the records it has
+# committed itself.
+position = 0
+entries = inputs.entries(args.inputs)
+if args.resume:
+    for part in partitions:
+        part.resume()
+    behind = min(partitions, key=lambda part: part.journal.start)
+    position = behind.journal.start
+    print("Resuming", args.job, "after", position, "records", file=sys.stderr)
+    entries = behind.journal.skip(entries, inputs.name)
+else:
+    for part in partitions:
+        part.start()
+entries = inputs.read_ahead(entries, args.read_ahead)
+skips = Skips()
+if args.shard is not None:
+    entries = skips.select(entries, args.shard.keep)
+if args.incremental:
+    entries = skips.select(entries, imported.keep)
+shards = args.shard.count if args.shard is not None else 1
+
+# For each input, parse and look at
+for filename, record in stats.iterate("parse", eaccpf.parse_all(entries, args.stream, args.workers)):
+    # The inputs dropped unparsed before this one still count
+    position = position + 1 + skips.take(filename)
+    content_hash = None
+    if args.incremental:
+        content_hash = imported.take(filename)
+    eaccpf.report.parsed(filename, record)
+    ark = record.cpf.get("ark_id")
+    if args.shard is not None and not args.shard.owns(ark):
+        continue
+    # Records are spread over the connections by the hash that picked the shard
+    part = partitions[0]
+    if len(partitions) > 1:
+        part = partitions[ark_partition(ark, shards * len(partitions)) // shards]
+    if position > part.journal.start:
+        part.importer.put(part, position, filename, record, content_hash)
+    elif position == part.journal.start and filename != part.journal.last:
+        raise ValueError("input %d of job %s is %r, but the journal has %r" % (position, part.journal.job, filename, part.journal.last))
+for part in partitions:
+    part.importer.close()
+
+# Commit what is left
+i = 0
+for part in partitions:
+    part.commit()
+    i = i + part.count
 print("====================\n", "Inserted ", i, " total records")
+if args.incremental:
+    print("Skipped", imported.unchanged, "unchanged files", file=sys.stderr)
+print("Vocabulary cache:", vocab.hits, "hits,", vocab.misses, "misses", file=sys.stderr)
+if args.vocabulary_snapshot is not None:
+    vocab.save(args.vocabulary_snapshot)
 
-# Close the database connection
-db_cur.close()
-db.close()
-        
+# Close the database connections
+for part in partitions:
+    part.close()
+if args.connections > 1:
+    db_cur.close()
+    db.close()
@@ -0,0 +1,93 @@
+from __future__ import print_function
+import argparse
+import sys
+import threading
+import time
+import traceback
+# Import the database backends
+import dbbackend
+# Import the shared database helpers
+from snacdb import plain_indexes, SCHEMA
+
+# Bulk load mode for the plain indexes of schema.sql:
+#
+#   python sql-indexes.py drop
+#   python sql-first-import.py ... ; python rel-import.py ...
+#   python sql-indexes.py build --jobs 4
+#
+# While they exist the indexes are updated row by row, for every row loaded.
+# Dropped for the load, each is built afterwards with one sort, several at a
+# time on connections of their own (largest tables first), and then the
+# database is analyzed so the planner knows what was loaded.  The unique
+# indexes are never dropped, as the importers find shared rows by them.
+
+# Command line options
+parser = argparse.ArgumentParser(description="Drop the plain indexes of schema.sql before a bulk load, or build them and ANALYZE after it")
+parser.add_argument("action", choices=("drop", "build"), help="drop the indexes, or build the missing ones")
+parser.add_argument("--jobs", type=int, default=2, metavar="N", help="indexes to build at once, each on its own connection (default: %(default)s)")
+parser.add_argument("--maintenance-work-mem", default="512MB", metavar="SIZE", help="memory each index build may sort in (default: %(default)s)")
+parser.add_argument("--schema", default=SCHEMA, metavar="FILE", help="schema the indexes are declared in (default: %(default)s)")
+dbbackend.add_arguments(parser)
+args = parser.parse_args()
+
+indexes = plain_indexes(args.schema)
+
+# Connect to the database
+db = dbbackend.connect(args)
+db_cur = db.cursor()
+
+if args.action == "drop":
+    for name, table, create in indexes:
+        db_cur.execute("DROP INDEX IF EXISTS " + name)
+    db.commit()
+    print("Dropped", len(indexes), "indexes", file=sys.stderr)
+    db_cur.close()
+    db.close()
+    sys.exit(0)
+
+# Largest tables first, so the longest builds do not come last
+db_cur.execute("SELECT relname, pg_relation_size(oid) FROM pg_class WHERE relname = ANY(%s)", [sorted(set([table for name, table, create in indexes]))])
+sizes = dict(db_cur.fetchall())
+db.commit()
+pending = sorted(indexes, key=lambda index: -sizes.get(index[1], 0))
+lock = threading.Lock()
+failed = []
+
+# Take indexes off the list and build them until there are none left
+def build():
+    conn = dbbackend.connect(args)
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute("SET maintenance_work_mem = %s", [args.maintenance_work_mem])
+    while True:
+        with lock:
+            if not pending:
+                break
+            name, table, create = pending.pop(0)
+        start = time.time()
+        try:
+            cur.execute(create)
+        except Exception:
+            traceback.print_exc()
+            failed.append(name)
+            continue
+        print("Built", name, "on", table, "in %.1f s" % (time.time() - start), file=sys.stderr)
+    cur.close()
+    conn.close()
+
+threads = [threading.Thread(target=build, name="build-%d" % k) for k in range(max(1, args.jobs))]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+
+# Refresh the planner statistics of everything loaded
+start = time.time()
+db.autocommit = True
+db_cur.execute("ANALYZE")
+print("Analyzed in %.1f s" % (time.time() - start), file=sys.stderr)
+
+db_cur.close()
+db.close()
+if failed:
+    sys.exit("Failed to build " + ", ".join(failed))
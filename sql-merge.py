@@ -0,0 +1,142 @@
+from __future__ import print_function
+import argparse
+import copy
+import sys
+import tempfile
+import time
+# Import the database backends
+import dbbackend
+# Import the shared database helpers
+from snacdb import UNIQUE_KEYS, RECORD_TABLES, Shard, shared_references
+
+# Merge step of a sharded import:
+#
+#   python sql-first-import.py --shard 0/3 --dsn "dbname=shard0" --relations rel.0 ...   (and 1/3, 2/3,
+#                                                                                          each into its own database)
+#   python sql-merge.py --dsn "dbname=eaccpf" --shard-dsn "dbname=shard0" --shard-dsn "dbname=shard1" ...
+#   python rel-import.py --dsn "dbname=eaccpf" --relations rel.0 --relations rel.1 ...
+#
+# The ids of the shards never collide (see Shard in snacdb.py), so the rows of
+# the records are copied over as they are.  The shared rows (vocabulary,
+# contributor, nationality, source and document) are merged by their unique
+# keys: a row already in the target database under another id is not copied,
+# and the columns that refer to it (as noted in schema.sql) are renumbered to
+# the target's id as the rows that use it are copied.  So are the ids of the
+# shard's versions of it in the _internal table, though where the target has
+# a version of the row under the same number it keeps its own.  Each shard is
+# merged in one transaction, and a row already in the target is left as it
+# is, so a failed merge can be run again.  The target is a database made with
+# schema.sql, or one of the shards' own (which then needs no --shard-dsn).
+# Relations cross the shards, so rel-import.py is run on the merged database.
+
+# Shared tables, each before the tables whose rows refer to it
+SHARED = ("vocabulary", "contributor", "nationality", "source", "document")
+
+# Tables of the records themselves; versioned ones are merged with their history
+RECORDS = ("cpf_internal", "name", "name_contributor", "cpf_place", "cpf_function", "cpf_relations") + RECORD_TABLES + ("import_source",)
+
+# Command line options
+parser = argparse.ArgumentParser(description="Merge the databases of a sharded import (sql-first-import.py --shard) into one")
+parser.add_argument("--shard-dsn", action="append", required=True, metavar="DSN", help="psycopg2 connection string of a shard's database; give one for each shard")
+dbbackend.add_arguments(parser)
+args = parser.parse_args()
+
+references = shared_references()
+
+# Connect to the target database, and to a shard's
+db = dbbackend.connect(args)
+db_cur = db.cursor()
+
+def connect(dsn):
+    shard_args = copy.copy(args)
+    shard_args.dsn = dsn
+    return dbbackend.connect(shard_args)
+
+# Shard ids of the shared rows that the target has under other ids
+db_cur.execute("CREATE TEMP TABLE merge_map (tbl text, old int, new int, primary key (tbl, old))")
+
+def columns(table):
+    db_cur.execute("SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = %s ORDER BY ordinal_position", [table])
+    return [row[0] for row in db_cur.fetchall()]
+
+# Copy the rows of table from a shard, renumbering their references to shared
+# rows (and, with versions_of, their own ids as rows of that shared table);
+# with key, also note the shard's rows that the target already has
+def merge_table(shard_cur, table, key=None, versions_of=None):
+    names = columns(table)
+    if not names:
+        return 0
+    quoted = ",".join(['"%s"' % name for name in names])
+    data = tempfile.TemporaryFile()
+    try:
+        shard_cur.copy_expert("COPY %s (%s) TO STDOUT" % (table, quoted), data)
+        data.seek(0)
+        db_cur.execute("CREATE TEMP TABLE merge_stage (LIKE %s)" % table)
+        db_cur.copy_expert("COPY merge_stage (%s) FROM STDIN" % quoted, data)
+    finally:
+        data.close()
+    values = []
+    for name in names:
+        shared = references.get(table, {}).get(name)
+        if name == "id" and versions_of is not None:
+            shared = versions_of
+        if shared is None:
+            values.append('s."%s"' % name)
+        else:
+            values.append("COALESCE((SELECT m.new FROM merge_map m WHERE m.tbl = '%s' AND m.old = s.\"%s\"), s.\"%s\")" % (shared, name, name))
+    conflict = "ON CONFLICT DO NOTHING"
+    if key is not None:
+        conflict = "ON CONFLICT (%s) DO NOTHING" % ",".join(key)
+    db_cur.execute("INSERT INTO %s (%s) SELECT %s FROM merge_stage s %s" % (table, quoted, ",".join(values), conflict))
+    copied = db_cur.rowcount
+    if key is not None:
+        db_cur.execute("INSERT INTO merge_map (tbl, old, new) SELECT DISTINCT ON (s.id) %%s, s.id, t.id FROM merge_stage s JOIN %s t ON %s"
+                       " WHERE s.id <> t.id ORDER BY s.id, t.id" % (table, " AND ".join(['t."%s" = s."%s"' % (k, k) for k in key])), [table])
+    db_cur.execute("DROP TABLE merge_stage")
+    return copied
+
+def has_table(table):
+    db_cur.execute("SELECT to_regclass(%s) IS NOT NULL", [table])
+    return db_cur.fetchone()[0]
+
+for dsn in args.shard_dsn:
+    start = time.time()
+    shard = connect(dsn)
+    shard_cur = shard.cursor()
+    db_cur.execute("TRUNCATE merge_map")
+    for table in SHARED:
+        print("Merged", merge_table(shard_cur, table, UNIQUE_KEYS[table]), "new", table, "rows of", dsn, file=sys.stderr)
+        if has_table(table + "_internal"):
+            merge_table(shard_cur, table + "_internal", versions_of=table)
+    for table in RECORDS:
+        copied = merge_table(shard_cur, table)
+        if has_table(table + "_internal"):
+            merge_table(shard_cur, table + "_internal")
+        print("Copied", copied, table, "rows of", dsn, file=sys.stderr)
+    db.commit()
+    shard_cur.close()
+    shard.close()
+    print("Merged", dsn, "in %.1f s" % (time.time() - start), file=sys.stderr)
+
+# Hand out ids after the merged ones again, one at a time
+tables = dict((sequence, []) for sequence in Shard.SEQUENCES)
+for table in SHARED + RECORDS:
+    if "id" not in columns(table):
+        continue
+    if table == "vocabulary":
+        tables["vocabulary_id_seq"].append(table)
+    elif table == "cpf_internal":
+        tables["cpf_id_seq"].append(table)
+    else:
+        tables["unique_id_seq"].append(table)
+for sequence in Shard.SEQUENCES:
+    top = 0
+    for table in tables[sequence]:
+        db_cur.execute("SELECT max(id) FROM " + table)
+        top = max(top, db_cur.fetchone()[0] or 0)
+    db_cur.execute("ALTER SEQUENCE " + sequence + " INCREMENT BY 1")
+    db_cur.execute("SELECT setval(%s, GREATEST(%s, (SELECT last_value FROM " + sequence + ")))", [sequence, top])
+db.commit()
+
+db_cur.close()
+db.close()